@@ -5,8 +5,10 @@ import logging
 import os
 import fnmatch
 import sys
-from multiprocessing import Pool
+from multiprocessing import Pool, Process
 import signal
+from datetime import datetime
+import subprocess
 import rsyncbackup
 
 logger = logging.getLogger()
@@ -18,11 +20,33 @@ def init_worker():
     # cleanups and final status reporting.
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
-def run_backup(config_name, test, verify):
+def run_backup(config_name, args):
     try:
-        with rsyncbackup.RsyncBackup(config_name, test) as backup:
-            if verify:
-                backup.verify(verify)
+        job = 'verify' if args.verify_queued else 'backup'
+
+        with rsyncbackup.RsyncBackup(config_name, args.test, job) as backup:
+            if args.verify_queued:
+                backup.verify_queued()
+            elif args.verify:
+                backup.verify(args.verify)
+            elif args.verify_quick:
+                backup.verify(args.verify_quick, quick=True)
+            elif args.export:
+                backup.export(args.export, args.output)
+            elif args.replicate:
+                backup.replicate()
+            elif args.migrate:
+                backup.migrate(args.migrate)
+            elif args.restore:
+                backup.restore(args.restore, args.target, args.path,
+                               args.workers)
+            elif args.diff:
+                backup.diff(*args.diff)
+            elif args.audit:
+                backup.audit(args.sample_rate)
+            elif args.plan:
+                backup.plan_retention(args.plan_start, args.plan_days,
+                                      args.plan_every, dict(args.retention))
             else:
                 backup.backup()
                 backup.schedule_verification()
@@ -37,6 +61,44 @@ def run_backup(config_name, test, verify):
     except:
         logger.exception('Backup initialization error')
 
+def run_watcher(config_name):
+    try:
+        rsyncbackup.ChangeWatcher(config_name).run()
+    except KeyboardInterrupt:
+        sys.exit(2)
+    except:
+        logger.exception('Change watcher error')
+
+def run_verification_queue(args):
+    queue = rsyncbackup.VerificationQueue()
+
+    # Verifications may take hours, so stay out of the way of backups and
+    # other work by using the lowest CPU priority and idle I/O priority.
+    os.nice(19)
+    subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+
+    for conf in queue:
+        if not queue.in_window():
+            logger.info('Outside the verification window. Remaining '
+                        'verifications are left in the queue.')
+            break
+
+        run_backup(conf, args)
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a valid date' % value)
+
+def parse_retention(value):
+    try:
+        interval, retention = value.split('=')
+        return (interval, int(retention))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '%s is not on the form INTERVAL=N' % value)
+
 def get_all_configs():
     script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
     conf_dir = os.path.join(script_dir, 'conf.d')
@@ -58,6 +120,16 @@ def main():
                           action='store_true')
     me_group.add_argument('-c', '--config-name',
                           help='Select specific backup configuration.')
+    me_group.add_argument('-w', '--verify-queued',
+                          help='Run the verifications in the verification '
+                               'queue with low priority.',
+                          action='store_true')
+    parser.add_argument('-W', '--watch',
+                        help='Record changes in the source directory of '
+                             'local backups with "watch_changes" enabled, so '
+                             'the next backup only transfers the changes. '
+                             'Runs until stopped.',
+                        action='store_true')
     parser.add_argument('-p', '--processes', metavar='N', type=int,
                         help='Number of backups to run in parallel.')
     parser.add_argument('-q', '--quiet', help='Suppress output from script.',
@@ -67,6 +139,75 @@ def main():
                         help='Verify the integrity of the selected backup. If '
                              'no BACKUP is given the current backup is '
                              'selected.')
+    parser.add_argument('-k', '--verify-quick', metavar='BACKUP', nargs='?',
+                        const='_current_',
+                        help='Verify the selected backup by comparing file '
+                             'sizes and modification times, and only '
+                             'checksum changed files and a random sample. If '
+                             'no BACKUP is given the current backup is '
+                             'selected.')
+    parser.add_argument('-e', '--export', metavar='BACKUP', nargs='?',
+                        const='_current_',
+                        help='Export the selected backup to a tar archive '
+                             'and verify it while it is read. If no BACKUP '
+                             'is given the current backup is selected.')
+    parser.add_argument('-o', '--output', metavar='FILE', default='-',
+                        help='Tar archive to export to. Default is stdout.')
+    parser.add_argument('-s', '--restore', metavar='BACKUP', nargs='?',
+                        const='_current_',
+                        help='Restore the selected backup to --target and '
+                             'verify the files while they are restored. If '
+                             'no BACKUP is given the current backup is '
+                             'selected.')
+    parser.add_argument('--target', metavar='DIR',
+                        help='Directory to restore to. Use '
+                             '[user@]host:DIR to restore over SSH.')
+    parser.add_argument('--path', metavar='SUBTREE',
+                        help='Only restore this path within the backup.')
+    parser.add_argument('--workers', metavar='N', type=int, default=4,
+                        help='Number of parallel restore streams. Default '
+                             'is 4.')
+    parser.add_argument('-R', '--replicate',
+                        help='Replicate the backups to the replication '
+                             'target configured in the global configuration '
+                             'file.',
+                        action='store_true')
+    parser.add_argument('-m', '--migrate', metavar='ROOT',
+                        help='Move the backups of the selected label to '
+                             'another backup root, keeping the hard links '
+                             'between them.')
+    parser.add_argument('-d', '--diff', metavar=('BACKUP_A', 'BACKUP_B'),
+                        nargs=2,
+                        help='Show the files added, removed and modified '
+                             'between two backups based on their checksum '
+                             'files.')
+    parser.add_argument('-u', '--audit',
+                        help='Compare checksums calculated on the source '
+                             'with the checksums of the latest backup to '
+                             'detect changes missed by rsync.',
+                        action='store_true')
+    parser.add_argument('--sample-rate', metavar='RATE', type=float,
+                        default=1.0,
+                        help='Fraction of the files to check when auditing. '
+                             'Default is 1.0 (all files).')
+    parser.add_argument('-r', '--plan',
+                        help='Show which backups the retention policy would '
+                             'create and remove, and estimate the hard link '
+                             'and deletion work. Nothing is changed.',
+                        action='store_true')
+    parser.add_argument('--plan-start', metavar='DATE', type=parse_date,
+                        help='Simulate backup runs starting at DATE '
+                             '(YYYY-MM-DD) instead of now.')
+    parser.add_argument('--plan-days', metavar='N', type=int, default=1,
+                        help='Number of days to simulate. Default is 1.')
+    parser.add_argument('--plan-every', metavar='HOURS', type=int,
+                        default=24,
+                        help='Hours between simulated backup runs. Default '
+                             'is 24.')
+    parser.add_argument('--retention', metavar='INTERVAL=N',
+                        type=parse_retention, action='append', default=[],
+                        help='Override the configured retention for an '
+                             'interval when planning. May be repeated.')
     parser.add_argument('-t', '--test',
                         help='Dry run backup. Only logs will be written.',
                         action='store_true')
@@ -82,6 +223,27 @@ def main():
                         help='Set log level for console output.')
     args = parser.parse_args()
 
+    if not 0 < args.sample_rate <= 1:
+        parser.error('--sample-rate must be larger than 0 and at most 1')
+
+    if args.export and not args.config_name:
+        parser.error('--export requires --config-name')
+
+    if args.migrate and not args.config_name:
+        parser.error('--migrate requires --config-name')
+
+    if args.diff and not args.config_name:
+        parser.error('--diff requires --config-name')
+
+    if args.restore and not args.config_name:
+        parser.error('--restore requires --config-name')
+
+    if args.restore and not args.target:
+        parser.error('--restore requires --target')
+
+    if args.plan_every < 1:
+        parser.error('--plan-every must be at least 1')
+
     VERSION = '2.1.3'
 
     if args.version:
@@ -95,6 +257,13 @@ def main():
         ch.setLevel(args.log_level)
         logger.addHandler(ch)
 
+    if args.verify_queued:
+        try:
+            run_verification_queue(args)
+        except KeyboardInterrupt:
+            sys.exit(2)
+        sys.exit(0)
+
     workers = args.processes if args.processes else 2
     configs = list()
 
@@ -103,11 +272,24 @@ def main():
     elif args.config_name:
         configs = [args.config_name]
 
+    if args.watch:
+        # Every watcher runs until stopped, so they can not share a pool
+        watchers = [Process(target=run_watcher, args=(conf,))
+                    for conf in configs]
+        try:
+            for watcher in watchers:
+                watcher.start()
+            for watcher in watchers:
+                watcher.join()
+        except KeyboardInterrupt:
+            sys.exit(2)
+        sys.exit(0)
+
     try:
         with Pool(workers, init_worker) as pool:
             for conf in configs:
                 pool.apply_async(run_backup,
-                                 args=(conf, args.test, args.verify))
+                                 args=(conf, args))
             pool.close()
             pool.join()
     except KeyboardInterrupt:
@@ -6,12 +6,27 @@ import hashlib
 import subprocess
 import re
 import gzip
-from datetime import datetime
+import ctypes
+import ctypes.util
+import fcntl
+import glob
+import random
+import shlex
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
 import shutil
+from stat import S_ISDIR
+import tarfile
 import smtplib
 from email.mime.text import MIMEText
+from collections import deque
 from functools import partial
-from operator import attrgetter
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
+from concurrent.futures import (ThreadPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
 
 try:
     from os import scandir
@@ -24,6 +39,9 @@ class BackupException(Exception):
 
 
 class Backup(object):
+    # Maximum number of files in each shard of the checksum file
+    shard_size = 100000
+
     def __init__(self, path, logger):
         self.logger = logger
         self.path = None
@@ -32,6 +50,9 @@ class Backup(object):
         self.interval = None
         self.backup_dir = None
         self._checksum_file = None
+        self._checksum_index_file = None
+        self._metadata_file = None
+        self._chunk_file = None
         self._parse_path(path)
 
     @property
@@ -60,9 +81,175 @@ class Backup(object):
 
     @checksums.setter
     def checksums(self, checksums):
-        with gzip.open(self._checksum_file, 'wb') as f:
-            for filename, checksum in checksums:
-                f.write(checksum + b'  ' + filename + b'\n')
+        """
+        The checksums are written ordered by filename, which allows checksum
+        files to be compared without loading them into memory.
+
+        Each top level directory, split every shard_size files, is written as
+        a separate gzip member. Concatenated members are still read as one
+        stream by gzip and zcat, and the index file records the offset of
+        every member, so a shard can be read on its own.
+        """
+        shards = list()
+        shard = None
+
+        with open(self._checksum_file, 'wb') as f:
+            for filename, checksum in sorted(checksums):
+                top_dir = b''
+
+                if b'/' in filename:
+                    top_dir = filename.split(b'/', 1)[0]
+
+                if (shard is None or shard[2] != top_dir or
+                        shard[3] >= self.shard_size):
+                    if shard is not None:
+                        shard[0].close()
+                        shards.append((shard[1], f.tell() - shard[1],
+                                       shard[3], shard[4]))
+
+                    offset = f.tell()
+                    shard = [gzip.GzipFile(fileobj=f, mode='wb'), offset,
+                             top_dir, 0, filename]
+
+                shard[0].write(checksum + b'  ' + filename + b'\n')
+                shard[3] += 1
+
+            if shard is not None:
+                shard[0].close()
+                shards.append((shard[1], f.tell() - shard[1], shard[3],
+                               shard[4]))
+            else:
+                gzip.GzipFile(fileobj=f, mode='wb').close()
+
+        with open(self._checksum_index_file, 'wb') as f:
+            for offset, length, count, first_filename in shards:
+                f.write(b'%d %d %d %s\n' % (offset, length, count,
+                                             first_filename))
+
+    @property
+    def shards(self):
+        """
+        Return the shards of the checksum file as tuples of offset, length,
+        number of files and the first filename, or None if the checksum file
+        is not sharded.
+        """
+        if (not os.path.exists(self._checksum_index_file) or
+                not os.path.exists(self._checksum_file)):
+            return None
+
+        shards = list()
+
+        with open(self._checksum_index_file, 'rb') as f:
+            for line in f:
+                offset, length, count, first_filename = line.split(b' ', 3)
+                shards.append((int(offset), int(length), int(count),
+                               first_filename.rstrip(b'\n')))
+
+        return shards
+
+    def read_shard(self, shard):
+        with open(self._checksum_file, 'rb') as f:
+            f.seek(shard[0])
+            data = gzip.decompress(f.read(shard[1]))
+
+        for line in data.splitlines():
+            checksum, filename = line.split(None, 1)
+            yield (filename.strip(), checksum)
+
+    def get_checksums(self, path=None):
+        """
+        Return the checksums of the files in path, only reading the shards of
+        the checksum file that may contain them.
+        """
+        if not path:
+            for entry in self.checksums:
+                yield entry
+            return
+
+        path = path.rstrip(b'/')
+        shards = self.shards
+
+        if shards is None:
+            checksums = self.checksums
+        else:
+            # The files within path are ordered between path and path + '0',
+            # as '0' follows '/'
+            end = path + b'0'
+            selected = list()
+
+            for i, shard in enumerate(shards):
+                next_first = (shards[i + 1][3] if i + 1 < len(shards) else
+                              None)
+
+                if shard[3] < end and (next_first is None or
+                                       next_first > path):
+                    selected.append(shard)
+
+            checksums = (entry for shard in selected
+                         for entry in self.read_shard(shard))
+
+        for filename, checksum in checksums:
+            if filename == path or filename.startswith(path + b'/'):
+                yield (filename, checksum)
+
+    @property
+    def sorted_checksums(self):
+        """
+        Return the checksums ordered by filename. Checksum files written by
+        older versions are not ordered, and are sorted with sort(1) to keep
+        the memory usage bounded.
+        """
+        # Only ordered checksum files are sharded
+        if self.shards is not None:
+            return self.checksums
+
+        previous = None
+
+        for filename, checksum in self.checksums:
+            if previous is not None and filename < previous:
+                return self._sort_checksums()
+
+            previous = filename
+
+        return self.checksums
+
+    def _sort_checksums(self):
+        # The NUL byte sorts before any character in a filename, so sorting
+        # the lines sorts them by filename
+        p = subprocess.Popen(['sort'], shell=False, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             env=dict(os.environ, LC_ALL='C'))
+
+        for filename, checksum in self.checksums:
+            p.stdin.write(filename + b'\0' + checksum + b'\n')
+
+        p.stdin.close()
+
+        for line in p.stdout:
+            filename, checksum = line.rstrip(b'\n').split(b'\0', 1)
+            yield (filename, checksum)
+
+        p.stdout.close()
+        if p.wait() != 0:
+            raise BackupException('Unable to sort %s' % self.checksum_file[0])
+
+    @property
+    def sizes(self):
+        """
+        Return the checksums ordered by filename together with the file size
+        from the metadata file, or None if the size is unknown.
+        """
+        metadata = self.metadata
+        entry = next(metadata, None)
+
+        for filename, checksum in self.sorted_checksums:
+            while entry is not None and entry[0] < filename:
+                entry = next(metadata, None)
+
+            if entry is not None and entry[0] == filename:
+                yield (filename, checksum, entry[1])
+            else:
+                yield (filename, checksum, None)
 
     @property
     def checksum_file(self):
@@ -79,20 +266,167 @@ class Backup(object):
 
         return (filename, version)
 
+    @property
+    def metadata(self):
+        if os.path.exists(self._metadata_file):
+            with gzip.open(self._metadata_file, 'rb') as f:
+                for line in f:
+                    size, mtime, inode, filename = line.split(b' ', 3)
+                    filename = filename.rstrip(b'\n')
+                    inode = None if inode == b'-' else int(inode)
+
+                    yield (filename, int(size), int(mtime), inode)
+
+    @metadata.setter
+    def metadata(self, metadata):
+        """
+        The metadata is kept in a separate file to keep the checksum file
+        compatible with md5sum.
+        """
+        with gzip.open(self._metadata_file, 'wb') as f:
+            for filename, size, mtime, inode in metadata:
+                f.write(b'%d %d %s %s\n' % (
+                    size, mtime, b'-' if inode is None else b'%d' % inode,
+                    filename))
+
+    @property
+    def metadata_file(self):
+        if os.path.exists(self._metadata_file):
+            return self._metadata_file
+
+    @property
+    def chunks(self):
+        if os.path.exists(self._chunk_file):
+            with gzip.open(self._chunk_file, 'rb') as f:
+                for line in f:
+                    size, chunk_size, checksum, chunks, filename = line.split(
+                        b' ', 4)
+                    filename = filename.rstrip(b'\n')
+
+                    yield (filename, int(size), int(chunk_size), checksum,
+                           chunks.split(b','))
+
+    @chunks.setter
+    def chunks(self, chunks):
+        """
+        The chunk checksums of large files are kept in a separate file next to
+        the checksum file, together with the size and checksum of the whole
+        file, so they can be reused by the next backup if the file is
+        unchanged.
+        """
+        with gzip.open(self._chunk_file, 'wb') as f:
+            for filename, size, chunk_size, checksum, chunks in chunks:
+                f.write(b'%d %d %s %s %s\n' % (
+                    size, chunk_size, checksum, b','.join(chunks), filename))
+
     @property
     def files(self):
-        return self._get_files()
+        return self.walk()
 
-    def _get_files(self, path=None):
-        if path is None:
-            path = bytes(self.backup_dir, 'utf8')
+    @staticmethod
+    def _scan_dir(path, stat, all_entries):
+        files = list()
+        dirs = list()
 
         for entry in scandir(path):
-            if entry.is_file(follow_symlinks=False):
-                yield entry.path
-            elif entry.is_dir(follow_symlinks=False):
-                for dir_file in self._get_files(entry.path):
-                    yield dir_file
+            is_dir = entry.is_dir(follow_symlinks=False)
+
+            if not is_dir and not all_entries and not entry.is_file(
+                    follow_symlinks=False):
+                continue
+
+            if stat:
+                file_entry = (entry.path, entry.stat(follow_symlinks=False))
+            else:
+                file_entry = entry.path
+
+            if is_dir:
+                dirs.append((entry.name + b'/', entry.path, file_entry))
+            else:
+                files.append((entry.name, file_entry))
+
+        return (files, dirs)
+
+    def walk(self, sort=False, stat=False, workers=8, path=None,
+             all_entries=False):
+        """
+        Return all files in the backup, or in path within the backup.
+        Directories are listed iteratively in a thread pool, as each directory
+        listing may be a round trip on network attached storage.
+
+        If sort is True the files are returned ordered by their path. If stat
+        is True every file is returned as a tuple of the path and its
+        stat_result. If all_entries is True directories, symlinks and other
+        special files are returned as well, and every directory is returned
+        before its contents.
+        """
+        if path is None:
+            path = self.backup_dir
+
+        path = os.fsencode(path)
+
+        with ThreadPoolExecutor(workers) as executor:
+            if sort:
+                walker = self._walk_sorted(executor, path, stat, all_entries)
+            else:
+                walker = self._walk_unsorted(executor, path, stat,
+                                             all_entries)
+
+            for file_entry in walker:
+                yield file_entry
+
+    def _walk_unsorted(self, executor, path, stat, all_entries):
+        pending = {executor.submit(self._scan_dir, path, stat, all_entries)}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                files, dirs = future.result()
+
+                for name, dir_path, dir_entry in dirs:
+                    pending.add(executor.submit(self._scan_dir, dir_path,
+                                                stat, all_entries))
+
+                    if all_entries:
+                        yield dir_entry
+
+                for name, file_entry in files:
+                    yield file_entry
+
+    def _walk_sorted(self, executor, path, stat, all_entries):
+        """
+        Walk depth first with the entries of each directory sorted by name.
+        Directory names are sorted with a trailing slash, which makes the
+        resulting paths sorted bytewise. The subdirectories of a directory are
+        listed in parallel as soon as the directory is entered.
+        """
+        def get_entries(future):
+            files, dirs = future.result()
+            entries = [(name, False, file_entry) for name, file_entry in files]
+            entries.extend(
+                (name, True, (executor.submit(
+                    self._scan_dir, dir_path, stat, all_entries), dir_entry))
+                for name, dir_path, dir_entry in dirs)
+            entries.sort(key=itemgetter(0))
+
+            return iter(entries)
+
+        stack = [get_entries(executor.submit(self._scan_dir, path, stat,
+                                             all_entries))]
+
+        while stack:
+            entry = next(stack[-1], None)
+
+            if entry is None:
+                stack.pop()
+            elif entry[1]:
+                if all_entries:
+                    yield entry[2][1]
+
+                stack.append(get_entries(entry[2][0]))
+            else:
+                yield entry[2]
 
     @property
     def datetime(self):
@@ -111,9 +445,12 @@ class Backup(object):
         self.interval = interval
         self.backup_dir = os.path.join(self.path, 'backup')
         self._checksum_file = os.path.join(self.path, 'checksums.gz')
+        self._checksum_index_file = os.path.join(self.path, 'checksums.idx')
+        self._metadata_file = os.path.join(self.path, 'metadata.gz')
+        self._chunk_file = os.path.join(self.path, 'chunks.gz')
 
     @staticmethod
-    def get_checksum(file_path):
+    def get_checksum(file_path, throttle=None):
         """
         Return bytes instead of a string as bytes is used in all other checksum
         file operations as filenames are bytes without encoding in Linux.
@@ -123,24 +460,224 @@ class Backup(object):
         with open(file_path, 'rb') as f:
             for chunk in iter(partial(f.read, chunksize), b''):
                 md5.update(chunk)
+
+                if throttle:
+                    throttle(len(chunk))
+        return bytes(md5.hexdigest(), 'utf8')
+
+    @staticmethod
+    def get_chunk_checksums(file_path, chunk_size, throttle=None):
+        """
+        Return the checksum of the whole file and a list of checksums of every
+        chunk_size bytes of the file, calculated in a single pass.
+        """
+        md5 = hashlib.md5()
+        chunks = list()
+        chunksize = 128*512
+
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk_md5 = hashlib.md5()
+                remaining = chunk_size
+
+                while remaining > 0:
+                    block = f.read(min(chunksize, remaining))
+
+                    if not block:
+                        break
+
+                    md5.update(block)
+                    chunk_md5.update(block)
+                    remaining -= len(block)
+
+                    if throttle:
+                        throttle(len(block))
+
+                if remaining == chunk_size:
+                    break
+
+                chunks.append(bytes(chunk_md5.hexdigest(), 'utf8'))
+
+                if remaining > 0:
+                    break
+
+        return (bytes(md5.hexdigest(), 'utf8'), chunks)
+
+    @staticmethod
+    def get_chunk_checksum(file_path, offset, size, throttle=None):
+        md5 = hashlib.md5()
+        chunksize = 128*512
+
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+
+            while size > 0:
+                block = f.read(min(chunksize, size))
+
+                if not block:
+                    break
+
+                md5.update(block)
+                size -= len(block)
+
+                if throttle:
+                    throttle(len(block))
+
         return bytes(md5.hexdigest(), 'utf8')
 
-    def verify(self):
+    def _verify_chunks(self, file_path, filename, chunk_entry, throttle,
+                       executor, checkpoint):
+        """
+        Verify a large file chunk by chunk in parallel. Verified chunks are
+        recorded in the checkpoint, so an aborted verification continues where
+        it stopped, and the byte ranges of corrupt chunks are logged.
+        """
+        size, chunk_size, checksum, chunks = chunk_entry
+
+        try:
+            current_size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            return False
+
+        futures = list()
+
+        for i, chunk_checksum in enumerate(chunks):
+            if checkpoint is not None and (filename, i) in checkpoint:
+                continue
+
+            futures.append((i, executor.submit(
+                self.get_chunk_checksum, file_path, i * chunk_size,
+                chunk_size, throttle)))
+
+        corrupt = list()
+
+        for i, future in futures:
+            if future.result() == chunks[i]:
+                if checkpoint is not None:
+                    checkpoint.add(filename, i)
+                continue
+
+            start = i * chunk_size
+            end = min(start + chunk_size, size)
+
+            # Merge adjacent corrupt chunks into one range
+            if corrupt and corrupt[-1][1] == start:
+                corrupt[-1] = (corrupt[-1][0], end)
+            else:
+                corrupt.append((start, end))
+
+        for start, end in corrupt:
+            self.logger.error('[CORRUPT] %s bytes %d-%d', file_path, start,
+                              end - 1)
+
+        if current_size != size:
+            self.logger.error('[SIZE CHANGED] %s %d bytes, expected %d',
+                              file_path, current_size, size)
+
+        return not corrupt and current_size == size
+
+    def _verify_file(self, filename, checksum, throttle, chunks, executor,
+                     checkpoint):
+        file_path = os.path.join(bytes(self.backup_dir, 'utf8'), filename)
+        chunk_entry = chunks.get(filename)
+
+        if chunk_entry is not None and chunk_entry[2] == checksum:
+            return (file_path, self._verify_chunks(
+                file_path, filename, chunk_entry, throttle, executor,
+                checkpoint))
+
+        try:
+            current_checksum = self.get_checksum(file_path, throttle)
+        except FileNotFoundError:
+            current_checksum = None
+
+        return (file_path, current_checksum == checksum)
+
+    def _verify_shard(self, shard, throttle, chunks, executor, checkpoint):
+        return [self._verify_file(filename, checksum, throttle, chunks,
+                                  executor, checkpoint)
+                for filename, checksum in self.read_shard(shard)]
+
+    def verify(self, throttle=None, workers=4, checkpoint=None):
+        """
+        Files with chunk checksums are verified one chunk at a time in
+        parallel. If a VerificationCheckpoint is given, chunks verified by an
+        earlier aborted verification are skipped.
+        """
         files = {f for f in self.files}
+        shards = self.shards
+        chunks = {entry[0]: entry[1:] for entry in self.chunks}
+
+        with ThreadPoolExecutor(workers) as chunk_executor:
+            if shards is not None:
+                # Verify the shards in parallel, but only keep the results of
+                # a few shards in memory at a time
+                with ThreadPoolExecutor(workers) as executor:
+                    pending = deque()
+
+                    for shard in shards:
+                        pending.append(executor.submit(
+                            self._verify_shard, shard, throttle, chunks,
+                            chunk_executor, checkpoint))
+
+                        while pending and (len(pending) > workers * 2 or
+                                           shard is shards[-1]):
+                            for file_path, verified in (
+                                    pending.popleft().result()):
+                                files.discard(file_path)
+                                yield (file_path, verified)
+
+                for file_path in files:
+                    yield (file_path, None)
+
+                return
+
+            for filename, checksum in self.checksums:
+                file_path, verified = self._verify_file(
+                    filename, checksum, throttle, chunks, chunk_executor,
+                    checkpoint)
+                files.discard(file_path)
+
+                yield (file_path, verified)
+
+        for file_path in files:
+            yield (file_path, None)
+
+    def verify_quick(self, sample_rate, throttle=None):
+        """
+        Compare size, modification time and inode of every file with the
+        values recorded at backup time. Only files that differ and a random
+        sample of the remaining files are checksummed. The third value of
+        each result tells whether the file was checksummed.
+        """
+        files = {file_path: (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                 for file_path, stat in self.walk(stat=True)}
+        metadata = {filename: (size, mtime, inode)
+                    for filename, size, mtime, inode in self.metadata}
 
         for filename, checksum in self.checksums:
             file_path = os.path.join(bytes(self.backup_dir, 'utf8'), filename)
-            current_checksum = self.get_checksum(file_path)
-            files.discard(file_path)
-            verified = False
+            current = files.pop(file_path, None)
+
+            if current is None:
+                yield (file_path, False, False)
+                continue
 
-            if current_checksum == checksum:
-                verified = True
+            expected = metadata.get(filename)
+            suspicious = (
+                expected is None or
+                expected[0] != current[0] or
+                expected[1] != current[1] or
+                (expected[2] is not None and expected[2] != current[2]))
 
-            yield (file_path, verified)
+            if suspicious or random.random() < sample_rate:
+                current_checksum = self.get_checksum(file_path, throttle)
+                yield (file_path, current_checksum == checksum, True)
+            else:
+                yield (file_path, True, False)
 
         for file_path in files:
-            yield (file_path, None)
+            yield (file_path, None, False)
 
     def set_current(self):
         """
@@ -158,331 +695,2130 @@ class Backup(object):
         self.logger.debug('Pointing "current" symlink to %s', link_src)
         os.symlink(link_src, current)
 
-    def remove(self):
-        subprocess.check_call(['rm', '-rf', self.path])
+    def remove(self, throttle=None):
+        """
+        Remove the backup. With throttle, which is called for every removed
+        file and directory, the files are removed one at a time instead of
+        with rm -rf.
+        """
+        if not throttle:
+            subprocess.check_call(['rm', '-rf', self.path])
+            return
+
+        for root, dirs, files in os.walk(self.path, topdown=False):
+            for name in files:
+                os.unlink(os.path.join(root, name))
+                throttle()
+
+            for name in dirs:
+                path = os.path.join(root, name)
+
+                # Symlinks to directories are listed as directories
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+
+                throttle()
+
+        os.rmdir(self.path)
 
     def move(self, new_path):
         shutil.move(self.path, new_path)
         self._parse_path(new_path)
 
 
-class RsyncBackup(object):
-    def __init__(self, config_name, test=False):
-        self.logger = logging.getLogger('%s.%s' % (__name__, config_name))
-        self.logger.setLevel(logging.DEBUG)
-
-        self.error = True
-        self.status = 'Backup failed!'
-        self.pid_created = False
+class VerificationQueue(object):
+    """
+    Persistent queue of due backup verifications. Every queued verification
+    is a file named after the backup configuration in the queue directory,
+    and is processed oldest first by a separate low priority worker.
+    """
+    def __init__(self):
         script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
-
-        # Load the global configuration file
         configfile_global = os.path.join(script_dir, 'rsync-backup.conf')
-        self.global_config = configparser.ConfigParser(
+        global_config = configparser.ConfigParser(
             interpolation=configparser.ExtendedInterpolation())
-        self.global_config.read_file(open(configfile_global))
+        global_config.read_file(open(configfile_global))
 
-        # Load the backup configuration file
-        configfile_backup = os.path.join(script_dir, 'conf.d',
-                                         '%s.conf' % config_name)
-        self.config = configparser.ConfigParser(
-            interpolation=configparser.ExtendedInterpolation())
-        self.config.read_file(open(configfile_backup))
+        self.queue_dir = os.path.join(
+            BackupRoots(global_config).primary, 'verification_queue')
+        self.window = self._parse_window(global_config.get(
+            'general', 'verification_window', fallback=''))
 
-        self.test = test
-        current_datetime = datetime.now()
-        self.rules = configfile_backup.replace('.conf', '.rules')
-        self.timestamp = current_datetime.strftime('%Y-%m-%d-%H%M%S')
-        self.backup_root = os.path.join(
-            self.global_config.get('general', 'backup_root'),
-            self.config.get('general', 'label'))
-        self.log_dir = os.path.join(self.backup_root, 'logs')
-        self.log_file = os.path.join(self.log_dir, '%s.log' % self.timestamp)
-        self.to_addrs = set(self.config.get(
-            'reporting', 'to_addrs',
-            fallback=self.global_config.get(
-                'reporting', 'to_addrs')).split(','))
-        self.pidfile = '/var/run/backup/backup-%s.pid' % (
-            self.config.get('general', 'label'))
-        self.cache_dir = os.path.join(self.backup_root, 'cache')
-        self.backups_dir = os.path.join(self.backup_root, 'backups')
-        self.last_verification_file = os.path.join(
-            self.cache_dir, 'last_verification')
-        self.umask = int(self.global_config.get('general', 'umask',
-                                                fallback='0o077'), 8)
-        os.umask(self.umask)
+    def __iter__(self):
+        if not os.path.isdir(self.queue_dir):
+            return iter([])
 
-        # Configure backup intervals
-        self.intervals = {
-            'snapshot': {
-                'retention': self.config.getint(
-                    'retention', 'snapshot',
-                    fallback=self.global_config.getint('retention', 'snapshot')),
-            },
-            'daily': {
-                'retention': self.config.getint(
-                    'retention', 'daily',
-                    fallback=self.global_config.getint('retention', 'daily')),
-            },
-            'monthly': {
-                'retention': self.config.getint(
-                    'retention', 'monthly',
-                    fallback=self.global_config.getint('retention', 'monthly')),
-            },
-            'yearly': {
-                'retention': self.config.getint(
-                    'retention', 'yearly',
-                    fallback=self.global_config.getint('retention', 'yearly')),
-            }
-        }
+        entries = sorted(scandir(self.queue_dir),
+                         key=lambda entry: entry.stat().st_mtime)
 
-        # Check if backup is already running and set up logging
-        self._is_running()
-        self._create_dirs()
-        self._prepare_logging()
+        return iter([entry.name for entry in entries if entry.is_file()])
 
-    def __enter__(self):
-        return self
+    @staticmethod
+    def _parse_window(window):
+        if not window:
+            return None
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is KeyboardInterrupt:
-            self.status = 'Backup aborted!'
-            self.logger.error(self.status)
-        elif exc_type is not None:
-            self.logger.error(exc_value)
+        try:
+            start, end = window.split('-')
+            return (datetime.strptime(start.strip(), '%H:%M').time(),
+                    datetime.strptime(end.strip(), '%H:%M').time())
+        except ValueError:
+            raise BackupException(
+                '%s is not a valid value for VERIFICATION_WINDOW' % window)
 
-        self.cleanup()
+    def in_window(self, now=None):
+        if self.window is None:
+            return True
 
-    def cleanup(self):
-        self.report_status()
-        self.logger.info('END STATUS: %s', self.status)
+        if now is None:
+            now = datetime.now()
 
-        if self.pid_created:
-            os.remove(self.pidfile)
+        start, end = self.window
+        current = now.time()
 
-    @staticmethod
-    def _create_dir(directory):
-        # Use try/except to avoid a race condition between the check for an 
-        # existing directory and the creation of a new one when multiple
-        # backups running in parallel creates shared directories.
-        try:
-            os.makedirs(directory)
-        except FileExistsError:
-            pass
+        # The window may wrap around midnight, i.e. 22:00-06:00
+        if start <= end:
+            return start <= current < end
+
+        return current >= start or current < end
+
+
+class VerificationCheckpoint(object):
+    """
+    Record of the verified chunks of large files in a backup. Every verified
+    chunk is appended to the checkpoint file of the backup right away, so an
+    aborted verification of the same backup can skip them. The file is locked
+    while the verification runs, so a second verification of the same backup
+    raises BlockingIOError instead of sharing it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.verified = set()
+        self.lock = threading.Lock()
+        self.f = open(self.path, 'a+b')
 
-    @staticmethod
-    def _get_timestamp(file_path):
-        timestamp_datetime = None
         try:
-            with open(file_path, 'r') as f:
-                timestamp_datetime = datetime.strptime(f.readline().strip(),
-                                                       '%Y-%m-%d %H:%M:%S')
-        except IOError:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.f.close()
+            raise
+
+        self.f.seek(0)
+
+        for line in self.f:
+            try:
+                index, filename = line.rstrip(b'\n').split(b' ', 1)
+                self.verified.add((filename, int(index)))
+            except ValueError:
+                # Line cut short by an aborted verification
+                continue
+
+    def __contains__(self, chunk):
+        return chunk in self.verified
+
+    def __len__(self):
+        return len(self.verified)
+
+    def add(self, filename, index):
+        with self.lock:
+            self.f.write(b'%d %s\n' % (index, filename))
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class HashingReader(object):
+    """
+    File object wrapper calculating the md5 checksum of the data as it is
+    read, so a file can be verified while it is copied.
+    """
+    def __init__(self, f, throttle=None):
+        self.f = f
+        self.throttle = throttle
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+
+        if self.throttle:
+            self.throttle(len(data))
+
+        return data
+
+    @property
+    def checksum(self):
+        return bytes(self.md5.hexdigest(), 'utf8')
+
+
+class ChangeWatcher(object):
+    """
+    Record the paths changed in the source directory of a local backup with
+    inotify, so the next backup only has to transfer these paths instead of
+    walking the whole source directory.
+
+    Changed paths are appended to the change file in the cache directory,
+    relative to the source root, once per backup. Whenever changes may have
+    been lost, i.e. when the watcher starts or the inotify queue overflows, an
+    overflow marker is created, which makes the next backup do a full run.
+    The marker is also created when the change file grows too large.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE)
+    # Size of the change file in bytes above which a full backup is done
+    max_changes_size = 64 * 1024 ** 2
+
+    def __init__(self, config_name):
+        self.logger = logging.getLogger('%s.%s' % (__name__, config_name))
+        self.logger.setLevel(logging.DEBUG)
+        script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+        configfile_global = os.path.join(script_dir, 'rsync-backup.conf')
+        global_config = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation())
+        global_config.read_file(open(configfile_global))
+
+        configfile_backup = os.path.join(script_dir, 'conf.d',
+                                         '%s.conf' % config_name)
+        config = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation())
+        config.read_file(open(configfile_backup))
+
+        label = config.get('general', 'label')
+        source_dir = config.get('rsync', 'source_dir')
+
+        self.enabled = (
+            config.get('rsync', 'mode') == 'local' and
+            config.getboolean('rsync', 'watch_changes', fallback=False))
+        self.backup_root = os.path.join(
+            BackupRoots(global_config).get_root(label), label)
+        self.cache_dir = os.path.join(self.backup_root, 'cache')
+        self.changes_file = os.path.join(self.cache_dir, 'changes')
+        self.overflow_file = os.path.join(self.cache_dir, 'changes_overflow')
+        self.pidfile = '/var/run/backup/watch-%s.pid' % label
+        self.source_root = bytes(
+            source_dir if source_dir.endswith('/') else
+            os.path.dirname(source_dir), 'utf8')
+        self.source_dir = bytes(source_dir.rstrip('/') or '/', 'utf8')
+        self.watches = dict()
+        self.recorded = set()
+        self._fd = None
+        self._libc = None
+
+    @staticmethod
+    def lock(cache_dir):
+        """
+        Lock the change file, which is shared between the watcher and the
+        backup rotating it.
+        """
+        lock_file = open(os.path.join(cache_dir, 'changes.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    @staticmethod
+    def is_running(label):
+        try:
+            with open('/var/run/backup/watch-%s.pid' % label, 'r') as f:
+                os.kill(int(f.read().strip()), 0)
+        except (FileNotFoundError, ProcessLookupError, ValueError):
+            return False
+
+        return True
+
+    def _mark_overflow(self):
+        with self.lock(self.cache_dir):
+            open(self.overflow_file, 'w').close()
+
+    def _add_watches(self, path):
+        for root, dirs, files in os.walk(path):
+            # Do not record the changes caused by the backups themselves
+            if root == bytes(self.backup_root, 'utf8'):
+                dirs[:] = []
+                continue
+
+            wd = self._libc.inotify_add_watch(self._fd, root, self.WATCH_MASK)
+
+            if wd < 0:
+                self.logger.warning(
+                    'Unable to watch %s: %s', root.decode('utf8', 'replace'),
+                    os.strerror(ctypes.get_errno()))
+                self._mark_overflow()
+                continue
+
+            self.watches[wd] = root
+
+    def _write_changes(self, changes):
+        """
+        Append the paths not recorded since the change file was last rotated
+        by a backup. Nothing is recorded while a full backup is pending.
+        """
+        with self.lock(self.cache_dir):
+            if (os.path.exists(self.overflow_file) or
+                    not os.path.exists(self.changes_file)):
+                self.recorded.clear()
+
+            if os.path.exists(self.overflow_file):
+                return
+
+            with open(self.changes_file, 'ab') as f:
+                for path in changes:
+                    if path not in self.recorded:
+                        self.recorded.add(path)
+                        f.write(path + b'\0')
+
+                size = f.tell()
+
+            if size > self.max_changes_size:
+                self.logger.warning('More than %d MiB of changed paths '
+                                    'recorded. The next backup will be a full '
+                                    'backup.',
+                                    self.max_changes_size // 1024 ** 2)
+                open(self.overflow_file, 'w').close()
+                os.remove(self.changes_file)
+                self.recorded.clear()
+
+    def run(self):
+        if not self.enabled:
+            return
+
+        RsyncBackup._create_dir(self.cache_dir)
+        RsyncBackup._create_dir(os.path.dirname(self.pidfile))
+
+        with open(self.pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                     use_errno=True)
+            self._fd = self._libc.inotify_init()
+
+            if self._fd < 0:
+                raise BackupException('Unable to initialize inotify: %s' %
+                                      os.strerror(ctypes.get_errno()))
+
+            # Changes made before all watches are in place are not recorded
+            self._mark_overflow()
+            self.logger.info('Watching %s for changes',
+                             self.source_dir.decode('utf8', 'replace'))
+            self._add_watches(self.source_dir)
+            self._watch()
+        finally:
+            if self._fd is not None and self._fd >= 0:
+                os.close(self._fd)
+
+            os.remove(self.pidfile)
+
+    def _watch(self):
+        header = struct.Struct('iIII')
+
+        while True:
+            data = os.read(self._fd, 65536)
+            changes = list()
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, cookie, length = header.unpack_from(data, offset)
+                offset += header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    self.logger.warning('Inotify queue overflow. The next '
+                                        'backup will be a full backup.')
+                    self._mark_overflow()
+                    continue
+
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                if wd not in self.watches:
+                    continue
+
+                path = os.path.join(self.watches[wd], name)
+
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_MOVED_FROM | self.IN_MOVED_TO):
+                        # The watches below a moved directory keep their old
+                        # paths, so fall back to a full backup
+                        self._mark_overflow()
+                    elif mask & self.IN_CREATE:
+                        self._add_watches(path)
+
+                changes.append(os.path.relpath(path, self.source_root))
+
+            if changes:
+                self._write_changes(changes)
+
+
+class Governor(object):
+    """
+    Share the configured network bandwidth and disk read and write rates
+    between all running backup jobs, also across processes. Every job doing
+    I/O registers a file named after its pid with its priority in the
+    governor directory, and gets a share of the limits in proportion to its
+    priority. Jobs register when they first use the governor, so jobs only
+    reading the cache do not take a share.
+
+    The --bwlimit of a rsync process can not change while it runs, so the
+    rate given to rsync is also written to the registration file and kept
+    until rsync has finished. The reserved rates never exceed the limits.
+    """
+    # Write cost charged for every file or directory removed
+    remove_cost = 4096
+
+    def __init__(self, directory, bandwidth_limit=0, read_limit=0,
+                 write_limit=0, priority=1):
+        self.directory = directory
+        self.bandwidth_limit = bandwidth_limit
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.priority = max(1, priority)
+        self.registered = False
+        self._reserved = 0
+        self._rates_lock = threading.Lock()
+        self._rates = dict()
+
+    @property
+    def enabled(self):
+        return (self.bandwidth_limit > 0 or self.read_limit > 0 or
+                self.write_limit > 0)
+
+    # Seconds between checks for a free rsync rate
+    reserve_interval = 10
+
+    def register(self):
+        if not self.enabled or self.registered:
+            return
+
+        try:
+            os.makedirs(self.directory)
+        except FileExistsError:
             pass
-        except ValueError:
-            os.unlink(file_path)
-        return timestamp_datetime
 
-    def _run_rsync(self, rsync_command):
-        checksums = list()
-        p = subprocess.Popen(rsync_command, shell=False,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._write_registration()
+        self.registered = True
+
+    def unregister(self):
+        if not self.registered:
+            return
+
+        try:
+            os.remove(os.path.join(self.directory, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+
+        self.registered = False
+
+    def _write_registration(self):
+        with open(os.path.join(self.directory, str(os.getpid())), 'w') as f:
+            f.write('%d %d' % (self.priority, self._reserved))
+
+    def _get_registrations(self):
+        """
+        Return the priority and the reserved rsync rate of every running job
+        by pid.
+        """
+        registrations = dict()
+
+        for entry in scandir(self.directory):
+            if not entry.name.isdigit():
+                continue
+
+            try:
+                os.kill(int(entry.name), 0)
+            except ProcessLookupError:
+                # Stale registration from a job that did not exit cleanly
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            try:
+                with open(entry.path, 'r') as f:
+                    values = f.read().split()
+                priority = int(values[0]) if values else 1
+                reserved = int(values[1]) if len(values) > 1 else 0
+            except (FileNotFoundError, ValueError):
+                priority, reserved = 1, 0
+
+            registrations[int(entry.name)] = (priority, reserved)
+
+        return registrations
+
+    def _get_share(self):
+        """
+        Return the fraction of the limits this job is entitled to right now.
+        """
+        total = sum(priority for priority, reserved
+                    in self._get_registrations().values())
+
+        if total == 0:
+            return 1.0
+
+        return min(1.0, self.priority / total)
+
+    def _lock(self):
+        lock_file = open(os.path.join(self.directory, 'lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    @contextmanager
+    def reserve_bwlimit(self, logger):
+        """
+        Reserve a rate in KiB/s for rsync's --bwlimit while the context is
+        active, or None if unlimited. Everything rsync transfers is written
+        to the backup disk, so it is limited by both the bandwidth and the
+        write rate. The rate is this job's share of what other rsync
+        processes have not reserved. If less than half of the share is free,
+        wait for running rsync processes to return their rates.
+        """
+        limits = list()
+
+        if self.bandwidth_limit > 0:
+            limits.append(self.bandwidth_limit)
+
+        if self.write_limit > 0:
+            limits.append(self.write_limit * 1024)
+
+        if not limits:
+            yield None
+            return
+
+        self.register()
+        limit = min(limits)
+        waiting = False
+
+        while True:
+            with self._lock():
+                registrations = self._get_registrations()
+                total = sum(priority for priority, reserved
+                            in registrations.values())
+                share = limit * self.priority / max(total, self.priority)
+                free = limit - sum(
+                    reserved for pid, (priority, reserved)
+                    in registrations.items() if pid != os.getpid())
+
+                if free >= share / 2:
+                    self._reserved = max(1, int(min(share, free)))
+                    self._write_registration()
+                    break
+
+            if not waiting:
+                logger.info('Waiting for other jobs to free bandwidth')
+                waiting = True
+
+            time.sleep(self.reserve_interval)
+
+        try:
+            yield self._reserved
+        finally:
+            with self._lock():
+                self._reserved = 0
+                self._write_registration()
+
+    @property
+    def write_limited(self):
+        return self.enabled and self.write_limit > 0
+
+    @property
+    def ionice(self):
+        """
+        Return a command prefix running hard linking with idle I/O priority
+        if the write rate is limited, as cp -al can not be rate limited.
+        """
+        if not self.write_limited:
+            return []
+
+        self.register()
+        return ['ionice', '-c', '3']
+
+    def _throttle(self, kind, limit, size):
+        """
+        Sleep as needed to keep the rate within the current share of limit
+        MiB/s. The share is recalculated every few seconds, so the rate
+        follows jobs starting and finishing. Several threads may share the
+        rate, so only the sleep is done without holding the lock.
+        """
+        if limit <= 0:
+            return
+
+        with self._rates_lock:
+            self.register()
+            now = time.monotonic()
+            rate, start, count = self._rates.get(kind, (None, None, 0))
+
+            if start is None or now - start > 5:
+                rate = limit * 1024 * 1024 * self._get_share()
+                start = now
+                count = 0
+
+            count += size
+            self._rates[kind] = (rate, start, count)
+            delay = start + count / rate - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self, size):
+        self._throttle('read', self.read_limit, size)
+
+    def throttle_write(self, size):
+        self._throttle('write', self.write_limit, size)
+
+
+class BackupRoots(object):
+    """
+    The backup roots the labels are spread across. A label is placed on the
+    root with the most free space and inodes, weighted down by the current
+    I/O utilization of its device, the first time it is backed up. The
+    existing label directory then keeps it on that root, so --link-dest
+    always finds the previous backup, until it is migrated.
+    """
+    def __init__(self, global_config):
+        roots = global_config.get('general', 'backup_roots', fallback='')
+        self.roots = [os.path.normpath(root.strip())
+                      for root in roots.split(',') if root.strip()]
+
+        if not self.roots:
+            self.roots = [os.path.normpath(
+                global_config.get('general', 'backup_root'))]
+
+        self.min_free = global_config.getfloat(
+            'general', 'min_free_percent', fallback=5)
+        self.lock_file = '/var/run/backup/placement.lock'
+
+    @property
+    def primary(self):
+        """
+        The first root holds the files shared by all labels, i.e. the
+        verification queue.
+        """
+        return self.roots[0]
+
+    def find(self, label):
+        return [root for root in self.roots
+                if os.path.isdir(os.path.join(root, label))]
+
+    @staticmethod
+    def lock(label):
+        """
+        Lock the label while a migration moves it between roots.
+        """
+        lock_file = '/var/run/backup/label-%s.lock' % label
+        RsyncBackup._create_dir(os.path.dirname(lock_file))
+        lock_file = open(lock_file, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def get_root(self, label):
+        roots = self.find(label)
+
+        if not roots:
+            # The label may be between two roots in a running migration
+            with self.lock(label):
+                roots = self.find(label)
+
+                if not roots:
+                    roots = self._complete_migration(label)
+
+        if len(roots) > 1:
+            raise BackupException(
+                'The label %s exists in several backup roots (%s)' % (
+                    label, ', '.join(roots)))
+
+        if roots:
+            return roots[0]
+
+        if len(self.roots) == 1:
+            return self.roots[0]
+
+        return self.place(label)
+
+    def _complete_migration(self, label):
+        """
+        A migration interrupted after the label was moved aside in the old
+        root is completed by moving the copy in the new root in place.
+        """
+        migrated = [root for root in self.roots if os.path.isdir(
+            os.path.join(root, '.%s.migrated' % label))]
+
+        if not migrated:
+            return []
+
+        for root in self.roots:
+            staging_dir = os.path.join(root, '.%s.migrating' % label)
+
+            if os.path.isdir(staging_dir):
+                os.rename(staging_dir, os.path.join(root, label))
+                return [root]
+
+        return []
+
+    def place(self, label):
+        RsyncBackup._create_dir(os.path.dirname(self.lock_file))
+
+        with open(self.lock_file, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # Another job may have placed the label while waiting for the lock
+            roots = self.find(label)
+
+            if roots:
+                return roots[0]
+
+            candidates = [usage for usage in self.get_usage()
+                          if usage[1] >= self.min_free and
+                          usage[2] >= self.min_free]
+
+            if not candidates:
+                raise BackupException(
+                    'No backup root has at least %g%% free space and inodes '
+                    'for %s' % (self.min_free, label))
+
+            root = max(candidates,
+                       key=lambda usage: min(usage[1], usage[2]) *
+                       (1 - usage[3] / 2))[0]
+            RsyncBackup._create_dir(os.path.join(root, label))
+
+        return root
+
+    @staticmethod
+    def _get_io_ticks(root):
+        """
+        Return the milliseconds the device of root has spent doing I/O, or
+        None if it is not a block device, i.e. a network file system.
+        """
+        device = os.stat(root).st_dev
+
+        try:
+            with open('/sys/dev/block/%d:%d/stat' % (
+                    os.major(device), os.minor(device)), 'r') as f:
+                return int(f.read().split()[9])
+        except (FileNotFoundError, IndexError, ValueError):
+            return None
+
+    def get_usage(self, interval=1):
+        """
+        Return the percentage of free space and free inodes and the I/O
+        utilization, measured over interval seconds, of every available root.
+        """
+        roots = [root for root in self.roots if os.path.isdir(root)]
+        io_ticks = {root: self._get_io_ticks(root) for root in roots}
+        time.sleep(interval)
+        usage = list()
+
+        for root in roots:
+            stat = os.statvfs(root)
+            free_space = 100.0 * stat.f_bavail / stat.f_blocks
+            free_inodes = 100.0
+
+            # Some file systems, i.e. btrfs, have no fixed number of inodes
+            if stat.f_files > 0:
+                free_inodes = 100.0 * stat.f_favail / stat.f_files
+
+            utilization = 0.0
+            ticks = self._get_io_ticks(root)
+
+            if ticks is not None and io_ticks[root] is not None:
+                utilization = min(
+                    (ticks - io_ticks[root]) / (interval * 1000.0), 1.0)
+
+            usage.append((root, free_space, free_inodes, utilization))
+
+        return usage
+
+
+class RsyncBackup(object):
+    def __init__(self, config_name, test=False, job='backup'):
+        self.logger = logging.getLogger('%s.%s' % (__name__, config_name))
+        self.logger.setLevel(logging.DEBUG)
+
+        self.error = True
+        self.status = 'Backup failed!'
+        self.pid_created = False
+        script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+        # Load the global configuration file
+        configfile_global = os.path.join(script_dir, 'rsync-backup.conf')
+        self.global_config = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation())
+        self.global_config.read_file(open(configfile_global))
+
+        # Load the backup configuration file
+        configfile_backup = os.path.join(script_dir, 'conf.d',
+                                         '%s.conf' % config_name)
+        self.config = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation())
+        self.config.read_file(open(configfile_backup))
+
+        self.test = test
+        self.config_name = config_name
+        current_datetime = datetime.now()
+        self.rules = configfile_backup.replace('.conf', '.rules')
+        self.timestamp = current_datetime.strftime('%Y-%m-%d-%H%M%S')
+        self.backup_roots = BackupRoots(self.global_config)
+        self.to_addrs = set(self.config.get(
+            'reporting', 'to_addrs',
+            fallback=self.global_config.get(
+                'reporting', 'to_addrs')).split(','))
+        # Queued verifications use their own pidfile, so they do not keep
+        # backups of the same label from running
+        self.job = job
+        self.pidfile = '/var/run/backup/%s-%s.pid' % (
+            job, self.config.get('general', 'label'))
+        self.ssh_multiplexing = self.config.getboolean(
+            'rsync', 'ssh_multiplexing',
+            fallback=self.global_config.getboolean(
+                'general', 'ssh_multiplexing', fallback=False))
+        self.ssh_control_path = None
+        if (self.ssh_multiplexing and
+                self.config.get('rsync', 'mode') == 'ssh'):
+            # Labels using different keys on the same host, i.e. keys
+            # restricted to a forced command, must not share a master
+            self.ssh_control_path = '/var/run/backup/ssh/%s@%s-%s.sock' % (
+                self.config.get('rsync', 'ssh_user'),
+                self.config.get('rsync', 'source_host'),
+                hashlib.md5(bytes(os.path.abspath(
+                    self.config.get('rsync', 'ssh_key')),
+                    'utf8')).hexdigest()[:8])
+        self.ssh_master_started = False
+        self.governor = Governor(
+            '/var/run/backup/governor',
+            bandwidth_limit=self.global_config.getint(
+                'general', 'bandwidth_limit', fallback=0),
+            read_limit=self.global_config.getint(
+                'general', 'read_limit', fallback=0),
+            write_limit=self.global_config.getint(
+                'general', 'write_limit', fallback=0),
+            priority=self.config.getint('general', 'priority', fallback=1))
+        self.watch_changes = (
+            self.config.get('rsync', 'mode') == 'local' and
+            self.config.getboolean('rsync', 'watch_changes', fallback=False))
+        self.verification_queue_file = os.path.join(
+            self.backup_roots.primary, 'verification_queue', config_name)
+        self.chunk_threshold = self.config.getint(
+            'general', 'chunk_threshold',
+            fallback=self.global_config.getint(
+                'general', 'chunk_threshold', fallback=0)) * 1024 * 1024
+        self.chunk_size = self.config.getint(
+            'general', 'chunk_size',
+            fallback=self.global_config.getint(
+                'general', 'chunk_size', fallback=64)) * 1024 * 1024
+        self.umask = int(self.global_config.get('general', 'umask',
+                                                fallback='0o077'), 8)
+        os.umask(self.umask)
+        self._set_backup_root(os.path.join(
+            self.backup_roots.get_root(self.config.get('general', 'label')),
+            self.config.get('general', 'label')))
+
+        # Configure backup intervals
+        self.intervals = {
+            'snapshot': {
+                'retention': self.config.getint(
+                    'retention', 'snapshot',
+                    fallback=self.global_config.getint('retention', 'snapshot')),
+            },
+            'hourly': {
+                'retention': self.config.getint(
+                    'retention', 'hourly',
+                    fallback=self.global_config.getint('retention', 'hourly',
+                                                       fallback=0)),
+            },
+            'daily': {
+                'retention': self.config.getint(
+                    'retention', 'daily',
+                    fallback=self.global_config.getint('retention', 'daily')),
+            },
+            'weekly': {
+                'retention': self.config.getint(
+                    'retention', 'weekly',
+                    fallback=self.global_config.getint('retention', 'weekly',
+                                                       fallback=0)),
+            },
+            'monthly': {
+                'retention': self.config.getint(
+                    'retention', 'monthly',
+                    fallback=self.global_config.getint('retention', 'monthly')),
+            },
+            'yearly': {
+                'retention': self.config.getint(
+                    'retention', 'yearly',
+                    fallback=self.global_config.getint('retention', 'yearly')),
+            }
+        }
+
+        # Check if backup is already running and set up logging
+        self._is_running()
+        self._create_dirs()
+        self._prepare_logging()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is KeyboardInterrupt:
+            self.status = 'Backup aborted!'
+            self.logger.error(self.status)
+        elif exc_type is not None:
+            self.logger.error(exc_value)
+
+        self.cleanup()
+
+    def cleanup(self):
+        try:
+            self.report_status()
+            self.logger.info('END STATUS: %s', self.status)
+        finally:
+            # Stop the master even if reporting fails, ControlPersist keeps
+            # it running otherwise
+            if self.ssh_master_started:
+                self._stop_ssh_master()
+
+            self.governor.unregister()
+
+            if self.pid_created:
+                os.remove(self.pidfile)
+
+    def _set_backup_root(self, backup_root):
+        self.backup_root = backup_root
+        self.log_dir = os.path.join(self.backup_root, 'logs')
+        self.log_file = os.path.join(self.log_dir, '%s.log' % self.timestamp)
+        self.cache_dir = os.path.join(self.backup_root, 'cache')
+        self.backups_dir = os.path.join(self.backup_root, 'backups')
+        self.last_verification_file = os.path.join(
+            self.cache_dir, 'last_verification')
+        self.changes_file = os.path.join(self.cache_dir, 'changes')
+        self.last_full_backup_file = os.path.join(
+            self.cache_dir, 'last_full_backup')
+        self.replication_state_file = os.path.join(
+            self.cache_dir, 'replication')
+        self.verification_checkpoint_prefix = os.path.join(
+            self.cache_dir, 'verification_checkpoint_')
+        self.verification_lock_file = os.path.join(
+            self.cache_dir, 'verification.lock')
+
+    @staticmethod
+    def _create_dir(directory):
+        # Use try/except to avoid a race condition between the check for an 
+        # existing directory and the creation of a new one when multiple
+        # backups running in parallel creates shared directories.
+        try:
+            os.makedirs(directory)
+        except FileExistsError:
+            pass
+
+    @staticmethod
+    def _get_timestamp(file_path):
+        timestamp_datetime = None
+        try:
+            with open(file_path, 'r') as f:
+                timestamp_datetime = datetime.strptime(f.readline().strip(),
+                                                       '%Y-%m-%d %H:%M:%S')
+        except IOError:
+            pass
+        except ValueError:
+            os.unlink(file_path)
+        return timestamp_datetime
+
+    def _run_rsync(self, rsync_command):
+        checksums = list()
+
+        with self.governor.reserve_bwlimit(self.logger) as bwlimit:
+            if bwlimit:
+                self.logger.info('Limiting bandwidth to %d KiB/s', bwlimit)
+                rsync_command = (rsync_command[:1] +
+                                 ['--bwlimit=%d' % bwlimit] +
+                                 rsync_command[1:])
+
+            p = subprocess.Popen(rsync_command, shell=False,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+
+            while p.poll() is None:
+                for line in iter(p.stdout.readline, b''):
+                    line = line.strip()
+                    self.logger.info(line.decode('utf8'))
+
+                    # Extract md5 checksum from rsync output for new or
+                    # changed files
+                    if line.startswith(b'>f'):
+                        rsync_update_info = line.split(b' ', 2)
+                        file_checksum = rsync_update_info[1]
+                        file_path = rsync_update_info[2]
+                        checksums.append((file_path, file_checksum))
+
+        exit_code = p.returncode
+        if exit_code == 24:
+            self.logger.warning('Ignoring rsync exit code %s (Partial '
+                                'transfer due to vanished source files)',
+                                exit_code)
+        elif exit_code != 0:
+            raise BackupException(
+                'Rsync returned non-zero exit code [ %s ]' % exit_code)
+
+        return checksums
+
+    @staticmethod
+    def _get_end_status(log_file):
+        with open(log_file, 'r') as f:
+            try:
+                lastline = f.readlines()[-1]
+            except IndexError:
+                return 'Unknown status'
+
+            if 'END STATUS:' in lastline:
+                return lastline.split('END STATUS: ')[1].strip()
+            else:
+                return 'Unknown status'
+
+    @staticmethod
+    def _get_log_file_datetime(log_file):
+        timestamp = re.search(r'([0-9-]{17}).log$', log_file)
+        if timestamp:
+            return datetime.strptime(timestamp.group(1), '%Y-%m-%d-%H%M%S')
+
+    def _write_timestamp(self, file_path):
+        if self.test:
+            self.logger.debug('Updating timestamp in %s (DRY RUN)', file_path)
+            return
+
+        self.logger.debug('Updating timestamp in %s', file_path)
+
+        with open(file_path, 'w') as f:
+            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _create_dirs(self):
+        dirs = [
+            self.backup_root,
+            self.backups_dir,
+            self.log_dir,
+            self.cache_dir
+        ]
+
+        for d in dirs:
+            self._create_dir(d)
+
+    def _prepare_logging(self):
+        fmt = logging.Formatter(
+            '%(asctime)s [%(levelname)s] %(message)s')
+
+        # Create file handler for logging to file
+        fh = logging.FileHandler(self.log_file)
+        fh.setFormatter(fmt)
+        self.logger.addHandler(fh)
+
+    def schedule_verification(self):
+        self.error = True
+
+        interval = self.config.getint('general', 'verification_interval',
+                                      fallback=self.global_config.getint(
+                                          'general', 'verification_interval'))
+        if interval == 0:
+            self.logger.warning('Automatic backup verification is disabled. '
+                                'This is NOT recommended!')
+            return
+
+        last_verified = self._get_timestamp(self.last_verification_file)
+
+        if not last_verified:
+            self._write_timestamp(self.last_verification_file)
+            return
+
+        days_since_verification = (datetime.now() - last_verified).days
+
+        if (days_since_verification > interval):
+            self.logger.info('At least %d days have passed since the backup '
+                             'was last verified. Initializing verification...',
+                             interval)
+
+            if self.global_config.getboolean('general', 'verification_queue',
+                                             fallback=False):
+                # The time of the last verification is updated when a
+                # running verification finishes
+                if self._get_verified_backup() is not None:
+                    self.logger.info('The backup is being verified by the '
+                                     'verification queue')
+                else:
+                    self.queue_verification()
+            else:
+                self.verify()
+
+        self.error = False
+
+    def queue_verification(self):
+        """
+        Add the label to the verification queue unless it is already queued.
+        The queue is ordered by the modification time of the entries, so an
+        existing entry is left untouched to keep its place in the queue.
+        """
+        if self.test:
+            self.logger.info('Adding verification of the current backup to '
+                             'the verification queue (DRY RUN)')
+            return
+
+        self._create_dir(os.path.dirname(self.verification_queue_file))
+
+        try:
+            fd = os.open(self.verification_queue_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            self.logger.info('Verification of the current backup is already '
+                             'queued')
+            return
+
+        self.logger.info('Adding verification of the current backup to the '
+                         'verification queue')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    def verify_queued(self):
+        """
+        Verify the current backup and remove it from the verification queue.
+        The queue entry is removed when the verification starts, so an aborted
+        verification is not retried before the next backup queues it again.
+
+        Backups of the label may run during the verification, so the name of
+        the verified backup is kept in a locked file, which keeps the
+        retention from removing it and backups from queueing it again.
+        """
+        backup = self._get_latest_backup()
+
+        with open(self.verification_lock_file, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if os.path.exists(self.verification_queue_file):
+                os.remove(self.verification_queue_file)
+
+            if backup:
+                lock_file.truncate(0)
+                lock_file.write(backup.name)
+                lock_file.flush()
+                self.verify(backup.name, current=True)
+            else:
+                self.verify()
+
+    def _get_verified_backup(self):
+        """
+        Return the name of the backup a queued verification is verifying, or
+        None if no verification is running.
+        """
+        try:
+            lock_file = open(self.verification_lock_file, 'r')
+        except FileNotFoundError:
+            return None
+
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return lock_file.read().strip()
+
+        return None
+
+    def verify(self, backup_name='_current_', quick=False, current=False):
+        """
+        Verify a backup. If current is True backup_name is the current
+        backup, and a full verification updates the time of the last
+        verification.
+        """
+        self.status = 'Backup verification failed!'
+        self.error = True
+
+        if backup_name == '_current_':
+            backup = self._get_latest_backup()
+        else:
+            backup = self._get_backup_by_name(backup_name)
+
+        if not backup:
+            raise BackupException('There is no backup to verify')
+
+        self.logger.info('Initializing checksum verification for %s',
+                         backup.path)
+        checkpoint = None
+
+        if quick:
+            sample_rate = self.config.getfloat(
+                'general', 'verify_quick_sample_rate',
+                fallback=self.global_config.getfloat(
+                    'general', 'verify_quick_sample_rate', fallback=0.01))
+
+            if not backup.metadata_file:
+                self.logger.warning('No file metadata found for %s. All '
+                                    'files will be checksummed.', backup.path)
+
+            self.logger.info('Starting quick backup verification...')
+            results = backup.verify_quick(sample_rate,
+                                          self.governor.throttle)
+        else:
+            checkpoint = self._get_verification_checkpoint(backup)
+
+            self.logger.info('Starting backup verification...')
+            results = ((file_path, verified, True)
+                       for file_path, verified in backup.verify(
+                           self.governor.throttle, checkpoint=checkpoint))
+
+        checked_count = 0
+        hashed_count = 0
+        verified_count = 0
+        failed_count = 0
+        missing_count = 0
+
+        for file_path, verified, hashed in results:
+            checked_count += 1
+
+            if hashed:
+                hashed_count += 1
+
+            if verified:
+                verified_count += 1
+            elif verified is None:
+                missing_count += 1
+                self.logger.error('[CHECKSUM MISSING] %s', file_path)
+            else:
+                failed_count += 1
+                self.logger.error('[FAILED] %s', file_path)
+
+        # Use tuples in a list instead of a dictionary to make the stats output
+        # ordered
+        stats = list()
+        stats.extend([('Files checked', checked_count)])
+        if quick:
+            stats.extend([('Files checksummed', hashed_count)])
+        stats.extend([('Successful verifications', verified_count)])
+        stats.extend([('Failed verifications', failed_count)])
+        stats.extend([('Files missing checksum', missing_count)])
+        self._display_verification_stats(stats)
+
+        # The verification is complete, so it is not resumed
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        if failed_count != 0 or missing_count != 0:
+            self.logger.error('Backup verification failed!')
+        else:
+            self.status = 'Backup verification completed successfully!'
+            self.logger.info(self.status)
+
+        # A quick verification does not read all data, so it does not
+        # replace the full verification
+        if (backup_name == '_current_' or current) and not quick:
+            self._write_timestamp(self.last_verification_file)
+
+        self.error = False
+
+    def _get_verification_checkpoint(self, backup):
+        """
+        Return the checkpoint of a full verification of backup, or None in
+        test mode or if the backup is already being verified. Checkpoints of
+        backups that have been removed are discarded.
+        """
+        if self.test:
+            return None
+
+        prefix = self.verification_checkpoint_prefix
+        names = {b.name for b in self._get_backups()}
+
+        for path in glob.glob('%s*' % glob.escape(prefix)):
+            if path[len(prefix):] not in names:
+                os.remove(path)
+
+        try:
+            checkpoint = VerificationCheckpoint(prefix + backup.name)
+        except BlockingIOError:
+            self.logger.warning('%s is already being verified. Verifying it '
+                                'without a checkpoint.', backup.name)
+            return None
+
+        if len(checkpoint) > 0:
+            self.logger.info('Resuming verification, skipping %d chunks '
+                             'verified earlier', len(checkpoint))
+
+        return checkpoint
+
+    def _display_verification_stats(self, stats):
+        label_width = 26
+        self.logger.info('')
+
+        for line in stats:
+            self.logger.info('{0}: {1}'.format(line[0].ljust(label_width),
+                             line[1]))
+
+        self.logger.info('')
+
+    def export(self, backup_name='_current_', output='-'):
+        """
+        Write a backup to a tar stream and verify every file against the
+        checksum file while it is read, so the data is only read once. Hard
+        links within the backup are stored as hard links in the archive.
+        """
+        self.status = 'Backup export failed!'
+        self.error = True
+
+        if backup_name == '_current_':
+            backup = self._get_latest_backup()
+        else:
+            backup = self._get_backup_by_name(backup_name)
+
+        if not backup:
+            raise BackupException('There is no backup to export')
+
+        self.logger.info('Exporting %s to %s', backup.path,
+                         'stdout' if output == '-' else output)
+
+        checksums = dict(backup.checksums)
+        inode_checksums = dict()
+        exported_count = 0
+        verified_count = 0
+        failed_count = 0
+        missing_count = 0
+
+        if output == '-':
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+        else:
+            tar = tarfile.open(output, mode='w|')
+
+        with tar:
+            # Keep the layout of the backup folder, so the archive can be
+            # verified with md5sum after extraction
+            if backup.checksum_file[0]:
+                tar.add(backup.checksum_file[0],
+                        os.path.basename(backup.checksum_file[0]))
+
+            tar.add(backup.backup_dir, 'backup', recursive=False)
+
+            for file_path, stat in backup.walk(sort=True, stat=True,
+                                               all_entries=True):
+                file_path = os.fsdecode(file_path)
+                arcname = os.path.join('backup', os.path.relpath(
+                    file_path, backup.backup_dir))
+                filename = os.fsencode(arcname[len('backup/'):])
+                tarinfo = tar.gettarinfo(file_path, arcname)
+
+                if tarinfo.isreg():
+                    with open(file_path, 'rb') as f:
+                        reader = HashingReader(f, self.governor.throttle)
+                        tar.addfile(tarinfo, reader)
+
+                    inode_checksums[(stat.st_dev, stat.st_ino)] = (
+                        reader.checksum)
+                    current_checksum = reader.checksum
+                elif tarinfo.islnk():
+                    # The data was verified with the first link
+                    tar.addfile(tarinfo)
+                    current_checksum = inode_checksums[
+                        (stat.st_dev, stat.st_ino)]
+                else:
+                    tar.addfile(tarinfo)
+                    continue
+
+                exported_count += 1
+                checksum = checksums.pop(filename, None)
+
+                if checksum is None:
+                    missing_count += 1
+                    self.logger.error('[CHECKSUM MISSING] %s', file_path)
+                elif current_checksum == checksum:
+                    verified_count += 1
+                else:
+                    failed_count += 1
+                    self.logger.error('[FAILED] %s', file_path)
+
+        # Files left in the checksum file are missing from the backup
+        for filename in checksums:
+            failed_count += 1
+            self.logger.error('[MISSING] %s', os.path.join(
+                backup.backup_dir, os.fsdecode(filename)))
+
+        stats = list()
+        stats.extend([('Files exported', exported_count)])
+        stats.extend([('Successful verifications', verified_count)])
+        stats.extend([('Failed verifications', failed_count)])
+        stats.extend([('Files missing checksum', missing_count)])
+        self._display_verification_stats(stats)
+
+        if failed_count != 0 or missing_count != 0:
+            self.status = 'Backup export completed with verification failures!'
+            self.logger.error(self.status)
+        else:
+            self.status = 'Backup export completed successfully!'
+            self.logger.info(self.status)
+
+        self.error = False
+
+    def restore(self, backup_name, target, path=None, workers=4):
+        """
+        Restore a backup, or a path within it, to a local directory or to
+        [user@]host:directory over SSH. The files are streamed in batches as
+        tar archives to tar running on the target, in parallel, and are
+        verified against the checksum file while they are read. The verified
+        files of completed batches are recorded, so an interrupted restore can
+        be resumed by running the same restore again. In test mode only the
+        planned batches are logged.
+        """
+        self.status = 'Restore failed!'
+        self.error = True
+
+        if backup_name == '_current_':
+            backup = self._get_latest_backup()
+        else:
+            backup = self._get_backup_by_name(backup_name)
+
+        if not backup:
+            raise BackupException('There is no backup to restore')
+
+        source_path = backup.backup_dir
+
+        if path:
+            path = os.path.normpath(path).lstrip('/')
+
+            if path == '..' or path.startswith('../'):
+                raise BackupException('%s is outside the backup' % path)
+
+            source_path = os.path.join(backup.backup_dir, path)
+
+            if not os.path.lexists(source_path):
+                raise BackupException('%s does not exist in %s' % (
+                    path, backup.path))
+
+        journal_file = os.path.join(self.cache_dir, 'restore_%s' % (
+            hashlib.md5(bytes('%s %s %s' % (backup.name, target, path),
+                              'utf8')).hexdigest()))
+        restored = set()
+
+        if os.path.exists(journal_file):
+            with open(journal_file, 'rb') as f:
+                restored = {p for p in f.read().split(b'\0') if p}
+
+            self.logger.info('Resuming restore. %d files are already '
+                             'restored.', len(restored))
+
+        self.logger.info('Restoring %s to %s', source_path, target)
+        batches, dirs = self._plan_restore(backup, source_path, restored)
+
+        if self.test:
+            self.logger.info('Restoring %d files in %d batches and %d '
+                             'directories (DRY RUN)',
+                             sum(len(batch) for batch in batches),
+                             len(batches), len(dirs))
+            self.status = 'Restore completed successfully!'
+            self.error = False
+            return
+
+        restore_command = self._get_restore_command(target)
+        checksums = dict(backup.get_checksums(
+            os.fsencode(path) if path else None))
+        restored_count = 0
+        verified_count = 0
+        failed_count = 0
+        missing_count = 0
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self._restore_batch, backup, batch,
+                                       checksums, restore_command)
+                       for batch in batches]
+
+            try:
+                with open(journal_file, 'ab') as journal:
+                    for future in as_completed(futures):
+                        filenames, results = future.result()
+                        unverified = set()
+
+                        for filename, verified in results:
+                            file_path = os.path.join(backup.backup_dir,
+                                                     os.fsdecode(filename))
+
+                            if verified:
+                                verified_count += 1
+                                continue
+
+                            if verified is None:
+                                missing_count += 1
+                                self.logger.error('[CHECKSUM MISSING] %s',
+                                                  file_path)
+                            else:
+                                failed_count += 1
+                                self.logger.error('[FAILED] %s', file_path)
+
+                            unverified.add(filename)
+
+                        # Files that failed verification are not recorded,
+                        # so a resumed restore restores and reports them again
+                        restored_count += len(filenames)
+                        journal.write(b''.join(f + b'\0' for f in filenames
+                                               if f not in unverified))
+                        journal.flush()
+            except:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # Restore the directories last, so their permissions and modification
+        # times are not changed by restoring the files within them
+        self._restore_batch(backup, dirs, checksums, restore_command)
+        os.remove(journal_file)
+
+        stats = list()
+        stats.extend([('Files restored', restored_count)])
+        stats.extend([('Successful verifications', verified_count)])
+        stats.extend([('Failed verifications', failed_count)])
+        stats.extend([('Files missing checksum', missing_count)])
+        self._display_verification_stats(stats)
+
+        if failed_count != 0 or missing_count != 0:
+            self.status = 'Restore completed with verification failures!'
+            self.logger.error(self.status)
+        else:
+            self.status = 'Restore completed successfully!'
+            self.logger.info(self.status)
+
+        self.error = False
 
-        while p.poll() is None:
-            for line in iter(p.stdout.readline, b''):
-                line = line.strip()
-                self.logger.info(line.decode('utf8'))
+    def _get_restore_command(self, target):
+        m = re.match(r'^(?:([^@/:]+)@)?([^@/:]+):(.*)$', target)
 
-                # Extract md5 checksum from rsync output for new or
-                # changed files
-                if line.startswith(b'>f'):
-                    rsync_update_info = line.split(b' ', 2)
-                    file_checksum = rsync_update_info[1]
-                    file_path = rsync_update_info[2]
-                    checksums.append((file_path, file_checksum))
+        if not m:
+            self._create_dir(target)
+            return ['tar', '-x', '--numeric-owner', '-C', target]
 
-        exit_code = p.returncode
-        if exit_code == 24:
-            self.logger.warning('Ignoring rsync exit code %s (Partial '
-                                'transfer due to vanished source files)',
-                                exit_code)
-        elif exit_code != 0:
-            raise BackupException(
-                'Rsync returned non-zero exit code [ %s ]' % exit_code)
+        user = m.group(1) or self.config.get('rsync', 'ssh_user')
+        host = m.group(2)
+        directory = m.group(3) or '.'
 
-        return checksums
+        # Use the shared SSH master connection when restoring to the source
+        if (self.config.get('rsync', 'mode') == 'ssh' and
+                host == self.config.get('rsync', 'source_host')):
+            ssh_command = self._get_ssh_command()
+        else:
+            ssh_command = ['ssh', '-i', self.config.get('rsync', 'ssh_key')]
+
+        return ssh_command + [
+            '%s@%s' % (user, host),
+            'mkdir -p %s && tar -x --numeric-owner -C %s' % (
+                shlex.quote(directory), shlex.quote(directory))]
 
     @staticmethod
-    def _get_end_status(log_file):
-        with open(log_file, 'r') as f:
-            try:
-                lastline = f.readlines()[-1]
-            except IndexError:
-                return 'Unknown status'
+    def _plan_restore(backup, source_path, restored, batch_files=1000,
+                      batch_size=1024 ** 3):
+        """
+        Split the files to restore into batches. Hard linked files are kept
+        in the same batch, so tar can restore them as hard links.
+        """
+        groups = dict()
+        dirs = list()
 
-            if 'END STATUS:' in lastline:
-                return lastline.split('END STATUS: ')[1].strip()
-            else:
-                return 'Unknown status'
+        def add(file_path, stat):
+            filename = os.fsencode(os.path.relpath(file_path,
+                                                   backup.backup_dir))
+            key = (stat.st_dev, stat.st_ino)
 
-    @staticmethod
-    def _get_log_file_datetime(log_file):
-        timestamp = re.search(r'([0-9-]{17}).log$', log_file)
-        if timestamp:
-            return datetime.strptime(timestamp.group(1), '%Y-%m-%d-%H%M%S')
+            if key not in groups:
+                groups[key] = (stat.st_size, list())
 
-    def _write_timestamp(self, file_path):
-        if self.test:
-            self.logger.debug('Updating timestamp in %s (DRY RUN)', file_path)
-            return
+            if filename not in restored:
+                groups[key][1].append(file_path)
 
-        self.logger.debug('Updating timestamp in %s', file_path)
+        if os.path.isdir(source_path) and not os.path.islink(source_path):
+            dirs.append(source_path)
 
-        with open(file_path, 'w') as f:
-            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            for file_path, stat in backup.walk(sort=True, stat=True,
+                                               path=source_path,
+                                               all_entries=True):
+                file_path = os.fsdecode(file_path)
 
-    def _create_dirs(self):
-        dirs = [
-            self.backup_root,
-            self.backups_dir,
-            self.log_dir,
-            self.cache_dir
-        ]
+                if S_ISDIR(stat.st_mode):
+                    dirs.append(file_path)
+                else:
+                    add(file_path, stat)
+        else:
+            add(source_path, os.lstat(source_path))
 
-        for d in dirs:
-            self._create_dir(d)
+        batches = list()
+        batch = list()
+        size = 0
 
-    def _prepare_logging(self):
-        fmt = logging.Formatter(
-            '%(asctime)s [%(levelname)s] %(message)s')
+        for group_size, paths in groups.values():
+            if not paths:
+                continue
 
-        # Create file handler for logging to file
-        fh = logging.FileHandler(self.log_file)
-        fh.setFormatter(fmt)
-        self.logger.addHandler(fh)
+            if batch and (len(batch) >= batch_files or size >= batch_size):
+                batches.append(batch)
+                batch = list()
+                size = 0
 
-    def schedule_verification(self):
+            batch.extend(paths)
+            size += group_size
+
+        if batch:
+            batches.append(batch)
+
+        return (batches, dirs)
+
+    def _restore_batch(self, backup, paths, checksums, restore_command):
+        filenames = list()
+        results = list()
+        inode_checksums = dict()
+        p = subprocess.Popen(restore_command, shell=False,
+                             stdin=subprocess.PIPE)
+
+        try:
+            with tarfile.open(fileobj=p.stdin, mode='w|') as tar:
+                for file_path in paths:
+                    arcname = os.path.relpath(file_path, backup.backup_dir)
+                    filename = os.fsencode(arcname)
+                    tarinfo = tar.gettarinfo(file_path, arcname)
+                    stat = os.lstat(file_path)
+                    key = (stat.st_dev, stat.st_ino)
+
+                    if tarinfo.isreg():
+                        with open(file_path, 'rb') as f:
+                            reader = HashingReader(f, self.governor.throttle)
+                            tar.addfile(tarinfo, reader)
+
+                        inode_checksums[key] = reader.checksum
+                    else:
+                        tar.addfile(tarinfo)
+
+                    if tarinfo.isdir():
+                        continue
+
+                    filenames.append(filename)
+
+                    if tarinfo.isreg() or tarinfo.islnk():
+                        checksum = checksums.get(filename)
+
+                        if checksum is None:
+                            results.append((filename, None))
+                        else:
+                            results.append(
+                                (filename, inode_checksums[key] == checksum))
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        exit_code = p.wait()
+        if exit_code != 0:
+            raise BackupException(
+                'Restore command returned non-zero exit code [ %s ]' %
+                exit_code)
+
+        return (filenames, results)
+
+    def diff(self, backup_name_a, backup_name_b):
+        """
+        Compare two backups using their checksum files only. The checksum
+        files are ordered by filename, so they are merged as streams without
+        loading them into memory.
+        """
+        self.status = 'Backup diff failed!'
         self.error = True
 
-        interval = self.config.getint('general', 'verification_interval',
-                                      fallback=self.global_config.getint(
-                                          'general', 'verification_interval'))
-        if interval == 0:
-            self.logger.warning('Automatic backup verification is disabled. '
-                                'This is NOT recommended!')
-            return
+        backups = list()
 
-        last_verified = self._get_timestamp(self.last_verification_file)
+        for backup_name in (backup_name_a, backup_name_b):
+            backup = self._get_backup_by_name(backup_name)
 
-        if not last_verified:
-            self._write_timestamp(self.last_verification_file)
-            return
+            if not backup or not backup.checksum_file[0]:
+                raise BackupException(
+                    'There is no backup with checksums named %s' %
+                    backup_name)
+
+            backups.append(backup)
+
+        self.logger.info('Comparing %s with %s', backups[0].path,
+                         backups[1].path)
+
+        counts = {'added': 0, 'removed': 0, 'modified': 0, 'unchanged': 0}
+        sizes = {'added': 0, 'removed': 0, 'modified': 0}
+        unknown_sizes = 0
+        old_files = backups[0].sizes
+        new_files = backups[1].sizes
+        old_entry = next(old_files, None)
+        new_entry = next(new_files, None)
+
+        while old_entry is not None or new_entry is not None:
+            if new_entry is None or (old_entry is not None and
+                                     old_entry[0] < new_entry[0]):
+                change = 'removed'
+                filename, checksum, size = old_entry
+                old_entry = next(old_files, None)
+            elif old_entry is None or new_entry[0] < old_entry[0]:
+                change = 'added'
+                filename, checksum, size = new_entry
+                new_entry = next(new_files, None)
+            else:
+                change = 'modified'
+                if old_entry[1] == new_entry[1]:
+                    change = 'unchanged'
 
-        days_since_verification = (datetime.now() - last_verified).days
+                filename, checksum, size = new_entry
+                old_entry = next(old_files, None)
+                new_entry = next(new_files, None)
 
-        if (days_since_verification > interval):
-            self.logger.info('At least %d days have passed since the backup '
-                             'was last verified. Initializing verification...',
-                             interval)
-            self.verify()
+            counts[change] += 1
+
+            if change == 'unchanged':
+                continue
+
+            self.logger.info('[%s] %s', change.upper(),
+                             filename.decode('utf8', 'replace'))
+
+            if size is None:
+                unknown_sizes += 1
+            else:
+                sizes[change] += size
 
+        stats = list()
+        stats.extend([('Files added', counts['added'])])
+        stats.extend([('Files removed', counts['removed'])])
+        stats.extend([('Files modified', counts['modified'])])
+        stats.extend([('Files unchanged', counts['unchanged'])])
+        stats.extend([('Bytes added', sizes['added'])])
+        stats.extend([('Bytes removed', sizes['removed'])])
+        stats.extend([('Bytes modified', sizes['modified'])])
+
+        if unknown_sizes:
+            stats.extend([('Files with unknown size', unknown_sizes)])
+
+        self._display_verification_stats(stats)
+
+        self.status = 'Backup diff completed successfully!'
+        self.logger.info(self.status)
         self.error = False
 
-    def verify(self, backup_name='_current_'):
-        self.status = 'Backup verification failed!'
+    def audit(self, sample_rate=1.0):
+        """
+        Compare the checksums of the latest backup with checksums calculated
+        on the source. Files with changed size or modification time are
+        expected changes, but files with the same metadata and different
+        content have been missed by rsync.
+        """
+        self.status = 'Source audit failed!'
         self.error = True
 
-        if backup_name == '_current_':
-            backup = self._get_latest_backup()
-        else:
-            backup = self._get_backup_by_name(backup_name)
+        backup = self._get_latest_backup()
 
-        if not backup:
-            raise BackupException('There is no backup to verify')
+        if not backup or not backup.checksum_file[0]:
+            raise BackupException('There is no backup to audit')
 
-        self.logger.info('Initializing checksum verification for %s',
-                         backup.path)
+        self.logger.info('Initializing source audit of %s against %s '
+                         '(sample rate: %s)',
+                         self.config.get('rsync', 'source_dir'), backup.path,
+                         sample_rate)
 
-        self.logger.info('Starting backup verification...')
-        checked_count = 0
-        verified_count = 0
-        failed_count = 0
-        missing_count = 0
+        manifest = dict()
 
-        for file_path, verified in backup.verify():
-            checked_count += 1
+        for filename, checksum in backup.checksums:
+            if random.random() < sample_rate:
+                manifest[filename] = checksum
 
-            if verified:
+        changed_files = self._get_source_changes(backup, manifest)
+        unchanged_files = [f for f in manifest if f not in changed_files]
+        source_checksums = self._get_source_checksums(unchanged_files)
+        verified_count = 0
+        drift_count = 0
+
+        for filename, checksum in source_checksums:
+            if manifest.get(filename) == checksum:
                 verified_count += 1
-            elif verified is None:
-                missing_count += 1
-                self.logger.error('[CHECKSUM MISSING] %s', file_path)
             else:
-                failed_count += 1
-                self.logger.error('[FAILED] %s', file_path)
+                drift_count += 1
+                self.logger.error('[DRIFT] %s',
+                                  filename.decode('utf8', 'replace'))
+
+        vanished_count = (len(manifest) - len(changed_files) -
+                          verified_count - drift_count)
 
-        # Use tuples in a list instead of a dictionary to make the stats output
-        # ordered
         stats = list()
-        stats.extend([('Files checked', checked_count)])
-        stats.extend([('Successful verifications', verified_count)])
-        stats.extend([('Failed verifications', failed_count)])
-        stats.extend([('Files missing checksum', missing_count)])
+        stats.extend([('Files sampled', len(manifest))])
+        stats.extend([('Changed since backup', len(changed_files))])
+        stats.extend([('Vanished from source', vanished_count)])
+        stats.extend([('Unchanged files', verified_count)])
+        stats.extend([('Drifted files', drift_count)])
         self._display_verification_stats(stats)
 
-        if failed_count != 0 or missing_count != 0:
-            self.logger.error('Backup verification failed!')
+        # A wrong source root or an unreadable source makes every file look
+        # vanished, which must not pass as a successful audit
+        if unchanged_files and verified_count + drift_count == 0:
+            self.logger.error('No checksums could be calculated on the '
+                              'source')
+            return
+
+        if vanished_count * 2 > len(manifest):
+            self.logger.error('Most of the sampled files have vanished from '
+                              'the source. Check source_dir and the access '
+                              'to the source.')
+            return
+
+        if drift_count != 0:
+            self.status = 'Source drift detected!'
+            self.logger.error(self.status)
         else:
-            self.status = 'Backup verification completed successfully!'
+            self.status = 'Source audit completed successfully!'
             self.logger.info(self.status)
 
-        if backup_name == '_current_':
-            self._write_timestamp(self.last_verification_file)
-
         self.error = False
 
-    def _display_verification_stats(self, stats):
-        label_width = 26
-        self.logger.info('')
+    def _get_source_changes(self, backup, filenames):
+        """
+        Use a rsync dry run without checksums to find the files that have a
+        different size or modification time on the source than in the backup.
+        """
+        changed_files = set()
 
-        for line in stats:
-            self.logger.info('{0}: {1}'.format(line[0].ljust(label_width),
-                             line[1]))
+        rsync = self.config.get('rsync', 'pathname', fallback='rsync')
+        rsync_command = [
+            rsync,
+            '-lti',
+            '--dry-run',
+            '--from0',
+            '--files-from=-',
+            '--out-format=%i %n'
+        ]
+
+        if self.config.get('rsync', 'mode') == 'ssh':
+            rsync_command.extend(['-e', ' '.join(self._get_ssh_command())])
+
+        rsync_command.extend([self._get_source(self._get_source_root()),
+                              backup.backup_dir])
+
+        p = subprocess.Popen(rsync_command, shell=False,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        output, errors = p.communicate(b'\0'.join(filenames))
+        self._log_errors(errors)
+
+        for line in output.split(b'\n'):
+            rsynced_file = line.strip().split(b' ', 1)
+
+            if len(rsynced_file) == 2 and rsynced_file[1] in filenames:
+                changed_files.add(rsynced_file[1])
+
+        # Exit code 23 is expected for files that have vanished from the
+        # source since the backup
+        exit_code = p.returncode
+        if exit_code not in (0, 23, 24):
+            raise BackupException(
+                'Rsync returned non-zero exit code [ %s ]' % exit_code)
+
+        return changed_files
+
+    def _get_source_checksums(self, filenames):
+        if not filenames:
+            return
+
+        output, exit_code = self._run_on_source(
+            ['xargs', '-0', '-r', 'md5sum', '--'], b'\0'.join(filenames))
+
+        # xargs returns 123 if md5sum failed for some of the files
+        if exit_code not in (0, 123):
+            raise BackupException(
+                'Source checksum command returned non-zero exit code '
+                '[ %s ]' % exit_code)
+
+        for line in output.split(b'\n'):
+            if not line:
+                continue
+
+            checksum, filename = line.split(b'  ', 1)
+
+            # md5sum escapes filenames containing newlines or backslashes
+            if checksum.startswith(b'\\'):
+                checksum = checksum[1:]
+                filename = re.sub(
+                    rb'\\(.)',
+                    lambda m: b'\n' if m.group(1) == b'n' else m.group(1),
+                    filename)
+
+            yield (filename, checksum)
+
+    def _get_changed_files(self, old_backup, new_backup):
+        changed_files = set()
+
+        rsync = self.config.get('rsync', 'pathname', fallback='rsync')
+        rsync_command = [
+            rsync,
+            '-rtvi',
+            '--dry-run',
+            '--out-format=%i %n%L',
+            old_backup.backup_dir + os.sep,
+            new_backup.backup_dir + os.sep
+        ]
+
+        p = subprocess.Popen(rsync_command, shell=False,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        while p.poll() is None:
+            for line in iter(p.stdout.readline, b''):
+                line = line.strip()
+
+                if line.startswith(b'>f'):
+                    rsynced_file = line.split(b' ', 1)
+                    changed_files.add(rsynced_file[1])
+
+        exit_code = p.returncode
+        if exit_code != 0:
+            raise BackupException(
+                'Rsync returned non-zero exit code [ %s ]' % exit_code)
+
+        return changed_files
+
+    def _get_ssh_command(self):
+        command = ['ssh', '-i', self.config.get('rsync', 'ssh_key')]
+
+        if self.ssh_control_path:
+            if not self.ssh_master_started:
+                self._start_ssh_master()
+
+            # Without a running master ssh falls back to a normal connection
+            command.extend(['-o', 'ControlMaster=no',
+                            '-o', 'ControlPath=%s' % self.ssh_control_path])
+
+        return command
+
+    def _lock_ssh_master(self):
+        lock_file = open('%s.lock' % self.ssh_control_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _start_ssh_master(self):
+        """
+        Start a SSH master connection shared by all rsync and ssh processes
+        against the same source host. Backups of other labels on the same
+        host reuse the master, so every job using it registers itself with a
+        marker file containing its pid.
+        """
+        self.ssh_master_started = True
+        self._create_dir(os.path.dirname(self.ssh_control_path))
+        destination = '%s@%s' % (self.config.get('rsync', 'ssh_user'),
+                                 self.config.get('rsync', 'source_host'))
+        master_command = [
+            'ssh',
+            '-i', self.config.get('rsync', 'ssh_key'),
+            '-o', 'ControlPath=%s' % self.ssh_control_path,
+        ]
+
+        with self._lock_ssh_master():
+            open('%s.%d' % (self.ssh_control_path, os.getpid()), 'w').close()
+
+            if subprocess.call(master_command + ['-O', 'check', destination],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0:
+                self.logger.debug('Reusing SSH master connection %s',
+                                  self.ssh_control_path)
+                return
+
+            self.logger.debug('Starting SSH master connection %s',
+                              self.ssh_control_path)
+            exit_code = subprocess.call(
+                master_command + ['-M', '-N', '-f',
+                                  '-o', 'ControlPersist=yes', destination],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            if exit_code != 0:
+                self.logger.warning('Unable to start SSH master connection. '
+                                    'Using separate connections.')
+
+    def _stop_ssh_master(self):
+        """
+        Remove the marker file of this job and stop the SSH master if no
+        other running job is using it.
+        """
+        self.ssh_master_started = False
+        destination = '%s@%s' % (self.config.get('rsync', 'ssh_user'),
+                                 self.config.get('rsync', 'source_host'))
+
+        with self._lock_ssh_master():
+            try:
+                os.remove('%s.%d' % (self.ssh_control_path, os.getpid()))
+            except FileNotFoundError:
+                pass
+
+            for marker in glob.glob('%s.*' % glob.escape(
+                    self.ssh_control_path)):
+                pid = os.path.splitext(marker)[1][1:]
+
+                if not pid.isdigit():
+                    continue
+
+                try:
+                    os.kill(int(pid), 0)
+                    return
+                except ProcessLookupError:
+                    # Stale marker from a job that did not exit cleanly
+                    os.remove(marker)
+
+            if os.path.exists(self.ssh_control_path):
+                self.logger.debug('Stopping SSH master connection %s',
+                                  self.ssh_control_path)
+                subprocess.call([
+                    'ssh',
+                    '-o', 'ControlPath=%s' % self.ssh_control_path,
+                    '-O', 'exit', destination
+                ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _get_source(self, path):
+        mode = self.config.get('rsync', 'mode')
+
+        if mode == 'ssh':
+            return '%s@%s:%s' % (
+                self.config.get('rsync', 'ssh_user'),
+                self.config.get('rsync', 'source_host'),
+                path)
+        elif mode == 'local':
+            return path
+        else:
+            raise BackupException('%s is not a valid value for MODE' % mode)
+
+    def _get_source_root(self):
+        """
+        Return the source directory the relative paths in the checksum files
+        are based on. Without a trailing slash rsync creates the source
+        directory itself inside the backup.
+        """
+        source_dir = self.config.get('rsync', 'source_dir')
+
+        if source_dir.endswith('/'):
+            return source_dir
+
+        return os.path.dirname(source_dir)
+
+    def _run_on_source(self, command, stdin_data):
+        """
+        Run a command in the source root, either locally or on the source
+        host using the same SSH transport as rsync.
+        """
+        source_root = self._get_source_root()
+
+        if self.config.get('rsync', 'mode') == 'ssh':
+            remote_command = 'cd %s && %s' % (
+                shlex.quote(source_root),
+                ' '.join(shlex.quote(arg) for arg in command))
+            command = self._get_ssh_command() + [
+                '%s@%s' % (self.config.get('rsync', 'ssh_user'),
+                           self.config.get('rsync', 'source_host')),
+                remote_command]
+            cwd = None
+        else:
+            cwd = source_root
+
+        p = subprocess.Popen(command, shell=False, cwd=cwd,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        output, errors = p.communicate(stdin_data)
+        self._log_errors(errors)
+
+        return (output, p.returncode)
+
+    def _log_errors(self, errors):
+        for line in errors.splitlines():
+            if line.strip():
+                self.logger.warning(line.decode('utf8', 'replace'))
+
+    def _get_watched_changes(self, incomplete_backup):
+        """
+        Return a file with the paths recorded by the change watcher since the
+        last backup, or None if a full backup is needed.
+        """
+        if not self.watch_changes or self.test:
+            return None
+
+        interval = self.config.getint(
+            'rsync', 'full_backup_interval',
+            fallback=self.global_config.getint(
+                'general', 'full_backup_interval', fallback=7))
+        last_full_backup = self._get_timestamp(self.last_full_backup_file)
+        overflow_file = os.path.join(self.cache_dir, 'changes_overflow')
+        changes_run_file = '%s.run' % self.changes_file
+        reason = None
 
-        self.logger.info('')
+        if incomplete_backup:
+            reason = 'an incomplete backup is resumed'
+        elif not self._get_latest_backup():
+            reason = 'there is no previous backup'
+        elif not ChangeWatcher.is_running(self.config.get('general', 'label')):
+            reason = 'the change watcher is not running'
+        elif os.path.exists(overflow_file):
+            reason = 'changes may have been lost by the change watcher'
+        elif (not last_full_backup or
+                (datetime.now() - last_full_backup).days >= interval):
+            reason = 'a full backup is due'
+        elif '--inplace' in self.config.get('rsync', 'additional_options'):
+            reason = '--inplace would modify the previous backup'
+
+        # Changes recorded from now on belong to the next backup
+        with ChangeWatcher.lock(self.cache_dir):
+            if reason:
+                self.logger.info('Doing a full backup as %s', reason)
+
+                for path in (overflow_file, self.changes_file):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+                return None
+
+            if os.path.exists(self.changes_file):
+                os.replace(self.changes_file, changes_run_file)
+            else:
+                open(changes_run_file, 'w').close()
 
-    def _get_changed_files(self, old_backup, new_backup):
-        changed_files = set()
+        with open(changes_run_file, 'rb') as f:
+            changes = sorted({p for p in f.read().split(b'\0') if p})
 
-        rsync = self.config.get('rsync', 'pathname', fallback='rsync')
-        rsync_command = [
-            rsync,
-            '-rtvi',
-            '--dry-run',
-            '--out-format=%i %n%L',
-            old_backup.backup_dir + os.sep,
-            new_backup.backup_dir + os.sep
-        ]
+        # The paths are relative to the source root, which is the parent of
+        # source_dir unless it ends with a slash. Paths outside source_dir
+        # would be deleted from the backup by --delete-missing-args.
+        source_dir = self.config.get('rsync', 'source_dir')
+        prefix = b''
 
-        p = subprocess.Popen(rsync_command, shell=False,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if not source_dir.endswith('/'):
+            prefix = os.fsencode(os.path.basename(source_dir))
 
-        while p.poll() is None:
-            for line in iter(p.stdout.readline, b''):
-                line = line.strip()
+        outside = [
+            path for path in changes
+            if path == b'..' or path.startswith(b'../') or path.startswith(
+                b'/') or (prefix and path != prefix and
+                          not path.startswith(prefix + b'/'))]
 
-                if line.startswith(b'>f'):
-                    rsynced_file = line.split(b' ', 1)
-                    changed_files.add(rsynced_file[1])
+        if outside:
+            self.logger.warning('Doing a full backup as %d recorded paths '
+                                'are outside %s, i.e. %s', len(outside),
+                                source_dir,
+                                outside[0].decode('utf8', 'replace'))
+            os.remove(changes_run_file)
+            return None
 
-        exit_code = p.returncode
-        if exit_code != 0:
-            raise BackupException(
-                'Rsync returned non-zero exit code [ %s ]' % exit_code)
+        with open(changes_run_file, 'wb') as f:
+            f.write(b'\0'.join(changes))
 
-        return changed_files
+        self.logger.info('Backing up %d changed paths recorded by the change '
+                         'watcher', len(changes))
 
-    def _configure_rsync(self, backup):
+        return changes_run_file
+
+    def _configure_rsync(self, backup, changes_file=None):
         rsync = self.config.get('rsync', 'pathname', fallback='rsync')
         command = [
             rsync,
@@ -496,19 +2832,10 @@ class RsyncBackup(object):
         if self.test:
             command.extend(['-n'])
 
+        source = self._get_source(self.config.get('rsync', 'source_dir'))
+
         if self.config.get('rsync', 'mode') == 'ssh':
-            source = '%s@%s:%s' % (
-                self.config.get('rsync', 'ssh_user'),
-                self.config.get('rsync', 'source_host'),
-                self.config.get('rsync', 'source_dir'))
-            command.extend(
-                ['-e', 'ssh -i %s' % self.config.get('rsync', 'ssh_key')])
-        elif self.config.get('rsync', 'mode') == 'local':
-            source = self.config.get('rsync', 'source_dir')
-        else:
-            raise BackupException(
-                '%s is not a valid value for MODE' %
-                self.config.get('rsync', 'mode'))
+            command.extend(['-e', ' '.join(self._get_ssh_command())])
 
         if not os.path.isfile(self.rules):
             raise BackupException('%s does not exist' % self.rules)
@@ -518,7 +2845,26 @@ class RsyncBackup(object):
         # Check if previous backup exists and use this for hardlinking
         previous_backup = self._get_latest_backup()
 
-        if previous_backup:
+        if changes_file:
+            # The changed paths are relative to the source root like the
+            # paths in the backup
+            source = self._get_source(self._get_source_root())
+
+            # Start with a hard linked copy of the previous backup and only
+            # transfer the changed paths into it. Rsync would change the
+            # attributes of an unchanged file in place, which would also
+            # change the older backups sharing the inode, so the changed
+            # paths are unlinked first and relinked by --link-dest if they
+            # are unchanged.
+            command.extend(['-r', '--from0', '--files-from=%s' % changes_file,
+                            '--delete-missing-args',
+                            '--link-dest=%s' % previous_backup.backup_dir])
+            self._create_dir(backup.path)
+            subprocess.check_call(self.governor.ionice + [
+                'cp', '-al', previous_backup.backup_dir, backup.backup_dir
+            ])
+            self._unlink_changes(backup, changes_file)
+        elif previous_backup:
             command.append('--link-dest=%s' %
                            previous_backup.backup_dir)
 
@@ -528,6 +2874,23 @@ class RsyncBackup(object):
         command.extend([source, backup.backup_dir])
         return command
 
+    @staticmethod
+    def _unlink_changes(backup, changes_file):
+        backup_dir = bytes(backup.backup_dir, 'utf8')
+
+        with open(changes_file, 'rb') as f:
+            changes = [path for path in f.read().split(b'\0') if path]
+
+        for path in changes:
+            file_path = os.path.join(backup_dir, path)
+
+            try:
+                # Directories are not hard linked by cp -al
+                if not os.path.isdir(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
     def backup(self):
         self.status = 'Backup failed!'
         self.error = True
@@ -547,7 +2910,8 @@ class RsyncBackup(object):
         self.logger.info('Starting backup labeled \"%s\" to %s',
                          self.config.get('general', 'label'),
                          backup.backup_dir)
-        rsync_command = self._configure_rsync(backup)
+        changes_file = self._get_watched_changes(incomplete_backup)
+        rsync_command = self._configure_rsync(backup, changes_file)
         self.logger.debug('Command: %s',
                           ' '.join(element for element in rsync_command))
         rsync_checksums = self._run_rsync(rsync_command)
@@ -567,14 +2931,27 @@ class RsyncBackup(object):
             backup.checksums = checksums
             self.logger.info('Added %d md5 checksums to %s', len(checksums),
                              backup.checksum_file[0])
+            backup.metadata = self._get_metadata(backup)
+            self.logger.info('Added file metadata to %s',
+                             backup.metadata_file)
+
+            if self.chunk_threshold > 0:
+                backup.chunks = self._get_chunks(backup)
+
+            if changes_file:
+                os.remove(changes_file)
+            elif self.watch_changes:
+                self._write_timestamp(self.last_full_backup_file)
 
         if not self.test:
             backup.move(os.path.join(self.backups_dir,
                                      'snapshot_%s' % self.timestamp))
             backup.set_current()
 
-        self._create_interval_backups(backup)
-        self._remove_old_backups()
+        to_create, to_delete = self._plan_retention(
+            list(self._get_backups()), backup, datetime.now())
+        self._create_interval_backups(backup, to_create)
+        self._remove_old_backups(to_delete)
         self._remove_old_logs()
 
         if self.test:
@@ -585,39 +2962,91 @@ class RsyncBackup(object):
         self.logger.info(self.status)
         self.error = False
 
-    def _create_interval_backups(self, backup):
-        now = datetime.now()
-        skip_create = set()
-
-        for interval_backup in self._get_backups():
-            interval = interval_backup.interval
-            backup_date = interval_backup.datetime
-
-            if interval == 'yearly':
-                if backup_date.year == now.year:
-                    skip_create.add(interval)
-            elif interval == 'monthly':
-                if (backup_date.year == now.year and
-                        backup_date.month == now.month):
-                    skip_create.add(interval)
-            elif interval == 'daily':
-                if (backup_date.year == now.year and
-                        backup_date.month == now.month and
-                        backup_date.day == now.day):
-                    skip_create.add(interval)
+    @staticmethod
+    def _get_period(interval, date):
+        """
+        Return the period an interval backup made at the given date belongs
+        to. Only one backup per interval is created in each period.
+        """
+        if interval == 'hourly':
+            return (date.year, date.month, date.day, date.hour)
+        elif interval == 'daily':
+            return (date.year, date.month, date.day)
+        elif interval == 'weekly':
+            return date.isocalendar()[:2]
+        elif interval == 'monthly':
+            return (date.year, date.month)
+        elif interval == 'yearly':
+            return (date.year,)
+
+    def _is_expired(self, interval, backup_date, now):
+        retention = self.intervals[interval]['retention']
+        age = now - backup_date
+
+        if interval == 'hourly':
+            return age.days * 24 + age.seconds // 3600 >= retention
+        elif interval == 'daily':
+            max_age = retention
+        elif interval == 'weekly':
+            max_age = retention * 7
+        elif interval == 'monthly':
+            max_age = retention * 365.25 / 12
+        elif interval == 'yearly':
+            max_age = retention * 365.25
+
+        return age.days >= max_age
+
+    def _plan_retention(self, backups, backup, now):
+        """
+        Return the interval backups to create from the new backup and the
+        backups to remove at the given time. Nothing is touched on disk, so
+        this is also used for simulating retention policies.
+        """
+        to_create = list()
+        to_delete = list()
+        existing_periods = {
+            (b.interval, self._get_period(b.interval, b.datetime))
+            for b in backups if b.interval in self.intervals}
 
         for interval in self.intervals:
             if interval == 'snapshot':
                 continue
 
-            if interval in skip_create:
+            if (interval, self._get_period(interval, now)) in existing_periods:
                 continue
 
             if self.intervals[interval]['retention'] < 1:
                 continue
 
-            path = os.path.join(self.backups_dir,
-                                '%s_%s' % (interval, backup.timestamp))
+            to_create.append(Backup(
+                os.path.join(self.backups_dir,
+                             '%s_%s' % (interval, backup.timestamp)),
+                self.logger))
+
+        snapshots = []
+
+        for planned_backup in backups + to_create:
+            interval = planned_backup.interval
+
+            if interval not in self.intervals:
+                to_delete.append(planned_backup)
+            elif interval == 'snapshot':
+                snapshots.append(planned_backup)
+            elif self._is_expired(interval, planned_backup.datetime, now):
+                to_delete.append(planned_backup)
+
+        # Use counts, not days, to enforce retention for snapshots
+        snapshots_sorted = sorted(snapshots, key=attrgetter('timestamp'),
+                                  reverse=True)
+        for planned_backup in snapshots_sorted[
+                self.intervals['snapshot']['retention']:]:
+            to_delete.append(planned_backup)
+
+        return (to_create, to_delete)
+
+    def _create_interval_backups(self, backup, to_create):
+        for interval_backup in to_create:
+            path = interval_backup.path
 
             if self.test:
                 self.logger.info('Creating %s (DRY RUN)', path)
@@ -626,47 +3055,146 @@ class RsyncBackup(object):
 
                 # Use cp instead of copytree because of performance reasons
                 #copytree(backup.path, path, copy_function=os.link)
-                subprocess.check_call([
+                subprocess.check_call(self.governor.ionice + [
                     'cp', '-al', backup.path, path
                 ])
 
-    def _remove_old_backups(self):
+    def _remove_old_backups(self, to_delete):
         self.logger.info('Removing old backups...')
-        to_delete = []
-        now = datetime.now()
-        snapshots = []
-
-        for backup in self._get_backups():
-            interval = backup.interval
-
-            if interval not in self.intervals:
-                to_delete.append(backup)
-                continue
-            elif interval == 'snapshot':
-                snapshots.append(backup)
-                continue
-            elif interval == 'daily':
-                max_age = self.intervals[interval]['retention']
-            elif interval == 'monthly':
-                max_age = self.intervals[interval]['retention'] * 365.25 / 12
-            elif interval == 'yearly':
-                max_age = self.intervals[interval]['retention'] * 365.25
 
-            if (now - backup.datetime).days >= max_age:
-                to_delete.append(backup)
-
-        # Use counts, not days, to enforce retention for snapshots
-        snapshots_sorted = sorted(snapshots, key=attrgetter('timestamp'),
-                                  reverse=True)
-        for backup in snapshots_sorted[self.intervals['snapshot']['retention']:]:
-            to_delete.append(backup)
+        verified_backup = self._get_verified_backup()
 
         for backup in to_delete:
-            if self.test:
+            if backup.name == verified_backup:
+                self.logger.info('Not removing %s as it is being verified. '
+                                 'It is removed by a later backup.',
+                                 backup.path)
+            elif self.test:
                 self.logger.debug('Removing %s (DRY RUN)', backup.path)
             else:
                 self.logger.debug('Removing %s', backup.path)
-                backup.remove()
+                backup.remove(self._get_remove_throttle())
+
+    def _get_remove_throttle(self):
+        """
+        Return a throttle for Backup.remove charging every removal against
+        the write rate share, or None if the write rate is unlimited.
+        """
+        if not self.governor.write_limited:
+            return None
+
+        return partial(self.governor.throttle_write,
+                       self.governor.remove_cost)
+
+    def _estimate_backup_size(self, backup):
+        """
+        Return the number of files and directories in a backup based on its
+        checksum file, without walking the backup itself.
+        """
+        files = 0
+        dirs = set()
+
+        for filename, checksum in backup.checksums:
+            files += 1
+            dirs.add(os.path.dirname(filename))
+
+        return (files, len(dirs))
+
+    def plan_retention(self, start=None, days=1, every=24, retention=None):
+        """
+        Simulate backup runs every given number of hours from start and
+        for the given number of days, and show which backups would be created
+        and removed. The hard link and deletion work is estimated from the
+        size of the latest backup.
+        """
+        self.status = 'Retention planning failed!'
+        self.error = True
+
+        for interval, value in (retention or dict()).items():
+            if interval not in self.intervals:
+                raise BackupException(
+                    '%s is not a valid retention interval' % interval)
+
+            self.intervals[interval]['retention'] = value
+
+        if start is None:
+            start = datetime.now()
+
+        backups = sorted(
+            (b for b in self._get_backups() if b.interval != 'incomplete'),
+            key=attrgetter('timestamp'))
+        latest_backup = self._get_latest_backup()
+        files = 0
+        dirs = 0
+
+        if latest_backup:
+            files, dirs = self._estimate_backup_size(latest_backup)
+
+        self.logger.info('Planning retention for %d days from %s with a '
+                         'backup every %d hours', days,
+                         start.strftime('%Y-%m-%d %H:%M'), every)
+        self.logger.info('Retention: %s', ', '.join(
+            '%s=%d' % (interval, self.intervals[interval]['retention'])
+            for interval in self.intervals))
+        self.logger.info('Estimated backup size: %d files, %d directories',
+                         files, dirs)
+
+        created_count = 0
+        deleted_count = 0
+        run_count = 0
+        now = start
+
+        while now < start + timedelta(days=days):
+            run_count += 1
+            backup = Backup(
+                os.path.join(self.backups_dir, 'snapshot_%s' %
+                             now.strftime('%Y-%m-%d-%H%M%S')),
+                self.logger)
+            backups.append(backup)
+            to_create, to_delete = self._plan_retention(backups, backup, now)
+
+            self.logger.info('')
+            self.logger.info('Backup run at %s',
+                             now.strftime('%Y-%m-%d %H:%M'))
+            self.logger.info('+ %s', backup.name)
+
+            for planned_backup in to_create:
+                self.logger.info('+ %s', planned_backup.name)
+
+            for planned_backup in to_delete:
+                self.logger.info('- %s', planned_backup.name)
+
+            created_count += len(to_create) + 1
+            deleted_count += len(to_delete)
+            backups = sorted(
+                (b for b in backups + to_create if b not in to_delete),
+                key=attrgetter('timestamp'))
+            now += timedelta(hours=every)
+
+        self.logger.info('')
+        self.logger.info('Backups kept after the last run:')
+
+        for backup in backups:
+            self.logger.info('  %s', backup.name)
+
+        # Every backup is a full tree of hard links to shared files, so
+        # creating or removing it costs one link per file and one inode per
+        # directory.
+        stats = list()
+        stats.extend([('Backup runs', run_count)])
+        stats.extend([('Backups created', created_count)])
+        stats.extend([('Backups removed', deleted_count)])
+        stats.extend([('Backups kept', len(backups))])
+        stats.extend([('Hard links created', created_count * files)])
+        stats.extend([('Hard links removed', deleted_count * files)])
+        stats.extend([('Directories created', created_count * dirs)])
+        stats.extend([('Directories removed', deleted_count * dirs)])
+        stats.extend([('Directory inodes kept', len(backups) * dirs)])
+        self._display_verification_stats(stats)
+
+        self.status = 'Retention planning completed successfully!'
+        self.logger.info(self.status)
+        self.error = False
 
     def _remove_old_logs(self):
         retention = self.config.getint(
@@ -691,6 +3219,341 @@ class RsyncBackup(object):
                     self.logger.debug('Removing %s', old_log)
                     os.unlink(old_log)
 
+    def _get_replication_state(self):
+        """
+        Return the names of the backups that have been completely replicated,
+        in the order they were replicated.
+        """
+        try:
+            with open(self.replication_state_file, 'r') as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return list()
+
+    def _write_replication_state(self, replicated):
+        if self.test:
+            return
+
+        state_file_tmp = '%s.tmp' % self.replication_state_file
+
+        with open(state_file_tmp, 'w') as f:
+            for name in replicated:
+                f.write('%s\n' % name)
+
+        os.replace(state_file_tmp, self.replication_state_file)
+
+    @staticmethod
+    def _is_copy(backup, other_backup):
+        """
+        Interval backups are hard linked copies of a snapshot, including the
+        checksum file, which makes them easy to recognize.
+        """
+        checksum_file = backup.checksum_file[0]
+        other_checksum_file = other_backup.checksum_file[0]
+
+        if not checksum_file or not other_checksum_file:
+            return False
+
+        return os.path.samefile(checksum_file, other_checksum_file)
+
+    def replicate(self):
+        """
+        Replicate all backups to the replication target one backup at a time
+        in chronological order. Every backup is hard linked against the
+        previously replicated backup on the target, so hard links are kept
+        without rsync having to match them across the whole repository.
+        """
+        self.status = 'Replication failed!'
+        self.error = True
+
+        target = self.global_config.get('replication', 'target',
+                                        fallback=None)
+
+        if not target:
+            raise BackupException('No replication target is configured')
+
+        target_dir = os.path.join(target, self.config.get('general', 'label'),
+                                  'backups')
+        self._create_dir(target_dir)
+
+        replicated = self._get_replication_state()
+        backups = sorted(
+            (b for b in self._get_backups() if b.interval != 'incomplete'),
+            key=lambda b: (b.timestamp, b.interval != 'snapshot'))
+        previous_backup = None
+        previous_target = None
+        replicated_count = 0
+        linked_count = 0
+
+        self.logger.info('Replicating %d backups to %s', len(backups),
+                         target_dir)
+
+        for backup in backups:
+            target_backup = Backup(os.path.join(target_dir, backup.name),
+                                   self.logger)
+
+            if backup.name in replicated:
+                previous_backup = backup
+                previous_target = target_backup
+                continue
+
+            if self._copy_backup(backup, target_backup, previous_backup,
+                                 previous_target):
+                replicated_count += 1
+            else:
+                linked_count += 1
+
+            replicated.append(backup.name)
+            self._write_replication_state(replicated)
+            previous_backup = backup
+            previous_target = target_backup
+
+        # Mirror the retention of the repository on the target
+        backup_names = {b.name for b in backups}
+
+        for name in list(replicated):
+            if name in backup_names:
+                continue
+
+            target_backup = Backup(os.path.join(target_dir, name), self.logger)
+
+            if self.test:
+                self.logger.debug('Removing %s (DRY RUN)', target_backup.path)
+            else:
+                self.logger.debug('Removing %s', target_backup.path)
+                target_backup.remove()
+
+            replicated.remove(name)
+            self._write_replication_state(replicated)
+
+        stats = list()
+        stats.extend([('Backups copied', replicated_count)])
+        stats.extend([('Backups hard linked', linked_count)])
+        stats.extend([('Backups on target', len(replicated))])
+        self._display_verification_stats(stats)
+
+        self.status = 'Replication completed successfully!'
+        self.logger.info(self.status)
+        self.error = False
+
+    def _copy_backup(self, backup, target_backup, previous_backup,
+                     previous_target):
+        """
+        Copy a backup hard linked against the copy of the previous backup.
+        Return False if it was a hard linked copy of the previous backup and
+        was copied with cp -al.
+        """
+        if previous_backup and self._is_copy(backup, previous_backup):
+            self._link_replica(previous_target, target_backup)
+            return False
+
+        self._rsync_replica(backup, target_backup, previous_target)
+        self._verify_replica(backup, target_backup, previous_backup)
+        return True
+
+    def migrate(self, root):
+        """
+        Move the backups, logs and cache of the label to another backup root.
+        Within a file system the label is simply renamed. Otherwise the
+        backups are copied one at a time in chronological order, hard linked
+        against the previous copy like a replication, to a staging directory
+        that is moved in place when everything is copied.
+        """
+        self.status = 'Migration failed!'
+        self.error = True
+
+        label = self.config.get('general', 'label')
+        root = os.path.normpath(root)
+        source_root = os.path.dirname(self.backup_root)
+        target_root = os.path.join(root, label)
+        staging_dir = os.path.join(root, '.%s.migrating' % label)
+        migrated_dir = os.path.join(source_root, '.%s.migrated' % label)
+
+        if root not in self.backup_roots.roots:
+            raise BackupException('%s is not a configured backup root' % root)
+
+        if root == source_root:
+            self.logger.info('%s is already in %s', label, root)
+            self._remove_migrated(label)
+            self.status = 'Migration completed successfully!'
+            self.error = False
+            return
+
+        if ChangeWatcher.is_running(label):
+            raise BackupException('Stop the change watcher of %s before '
+                                  'migrating it' % label)
+
+        if self._is_job_running('verify', label):
+            raise BackupException('A queued verification of %s is running. '
+                                  'Migrate it when it has finished' % label)
+
+        self.logger.info('Migrating %s to %s', self.backup_root, target_root)
+
+        if os.stat(root).st_dev == os.stat(source_root).st_dev:
+            if self.test:
+                self.logger.info('Renaming %s to %s (DRY RUN)',
+                                 self.backup_root, target_root)
+            else:
+                os.rename(self.backup_root, target_root)
+        else:
+            self._copy_label(staging_dir)
+
+            if self.test:
+                self.logger.info('Moving %s to %s (DRY RUN)', staging_dir,
+                                 target_root)
+            else:
+                # Move the old label aside first, so an interrupted
+                # migration is completed by BackupRoots. Other jobs wait for
+                # the label lock while the label is in neither root.
+                with BackupRoots.lock(label):
+                    os.rename(self.backup_root, migrated_dir)
+                    os.rename(staging_dir, target_root)
+
+        if not self.test:
+            for handler in list(self.logger.handlers):
+                if isinstance(handler, logging.FileHandler):
+                    self.logger.removeHandler(handler)
+                    handler.close()
+
+            self._set_backup_root(target_root)
+            self._prepare_logging()
+            self._remove_migrated(label)
+
+        self.status = 'Migration completed successfully!'
+        self.logger.info(self.status)
+        self.error = False
+
+    def _copy_label(self, staging_dir):
+        target_dir = os.path.join(staging_dir, 'backups')
+        self._create_dir(target_dir)
+
+        backups = sorted(self._get_backups(),
+                         key=lambda b: (b.timestamp, b.interval != 'snapshot'))
+        previous_backup = None
+        previous_target = None
+
+        for backup in backups:
+            target_backup = Backup(os.path.join(target_dir, backup.name),
+                                   self.logger)
+            self._copy_backup(backup, target_backup, previous_backup,
+                              previous_target)
+            previous_backup = backup
+            previous_target = target_backup
+
+        # Copy the logs, the cache and the current symlink last, so the log
+        # of the migration is as complete as possible
+        rsync_command = [
+            self.config.get('rsync', 'pathname', fallback='rsync'),
+            '-aH',
+            '--delete',
+            '--exclude=/backups/*/',
+            self.backup_root + os.sep,
+            staging_dir
+        ]
+
+        if self.test:
+            rsync_command.insert(1, '-n')
+
+        self.logger.debug('Command: %s',
+                          ' '.join(element for element in rsync_command))
+        self._run_rsync(rsync_command)
+
+    def _remove_migrated(self, label):
+        for root in self.backup_roots.roots:
+            migrated_dir = os.path.join(root, '.%s.migrated' % label)
+
+            if not os.path.isdir(migrated_dir):
+                continue
+
+            if self.test:
+                self.logger.debug('Removing %s (DRY RUN)', migrated_dir)
+            else:
+                self.logger.debug('Removing %s', migrated_dir)
+                subprocess.check_call(self.governor.ionice +
+                                      ['rm', '-rf', migrated_dir])
+
+    def _link_replica(self, previous_target, target_backup):
+        if self.test:
+            self.logger.info('Creating %s (DRY RUN)', target_backup.path)
+            return
+
+        self.logger.info('Creating %s', target_backup.path)
+
+        # A partial copy from an aborted run must be replaced
+        if os.path.exists(target_backup.path):
+            target_backup.remove()
+
+        subprocess.check_call(self.governor.ionice + [
+            'cp', '-al', previous_target.path, target_backup.path
+        ])
+
+    def _rsync_replica(self, backup, target_backup, previous_target):
+        rsync = self.config.get('rsync', 'pathname', fallback='rsync')
+        rsync_command = [
+            rsync,
+            '-aH',
+            '--numeric-ids',
+            '--delete'
+        ]
+        rsync_command.extend(self.global_config.get(
+            'replication', 'rsync_options', fallback='').split())
+
+        if self.test:
+            rsync_command.extend(['-n'])
+
+        if previous_target:
+            rsync_command.append('--link-dest=%s' % previous_target.path)
+
+        rsync_command.extend([backup.path + os.sep, target_backup.path])
+
+        self.logger.info('Copying %s to %s', backup.path, target_backup.path)
+        self.logger.debug('Command: %s',
+                          ' '.join(element for element in rsync_command))
+        self._run_rsync(rsync_command)
+
+    def _verify_replica(self, backup, target_backup, previous_backup):
+        """
+        Only files with a different checksum than in the previous backup have
+        been copied, so compare these with the checksum file instead of
+        reading the whole replica.
+        """
+        if self.test:
+            return
+
+        previous_checksums = dict()
+
+        if previous_backup:
+            previous_checksums = dict(previous_backup.checksums)
+
+        failed_count = 0
+        checked_count = 0
+
+        for filename, checksum in backup.checksums:
+            if previous_checksums.get(filename) == checksum:
+                continue
+
+            checked_count += 1
+            file_path = os.path.join(bytes(target_backup.backup_dir, 'utf8'),
+                                     filename)
+
+            try:
+                current_checksum = target_backup.get_checksum(
+                    file_path, self.governor.throttle)
+            except FileNotFoundError:
+                current_checksum = None
+
+            if current_checksum != checksum:
+                failed_count += 1
+                self.logger.error('[FAILED] %s', file_path)
+
+        self.logger.debug('Verified %d changed files in %s', checked_count,
+                          target_backup.path)
+
+        if failed_count != 0:
+            raise BackupException(
+                'Verification of %d files in %s failed' % (
+                    failed_count, target_backup.path))
+
     def _get_checksums(self, backup, rsync_checksums, changed_files=None):
         self.logger.info('Getting checksums for backup files...')
         checksums = list()
@@ -730,11 +3593,74 @@ class RsyncBackup(object):
 
         for filename in need_checksum:
             file_path = os.path.join(bytes(backup.backup_dir, 'utf8'), filename)
-            checksum = backup.get_checksum(file_path)
+            checksum = backup.get_checksum(file_path, self.governor.throttle)
             checksums.append((filename, checksum))
 
         return checksums
 
+    def _get_chunks(self, backup):
+        """
+        Return the chunk checksums of all files larger than chunk_threshold.
+        Chunk checksums of unchanged files are reused from the previous
+        backup, the rest are calculated together with the checksum of the
+        whole file, which must match the checksum file.
+        """
+        previous_backup = self._get_latest_backup()
+        previous_chunks = dict()
+
+        if previous_backup:
+            previous_chunks = {
+                (entry[0], entry[1], entry[3]): entry
+                for entry in previous_backup.chunks
+                if entry[2] == self.chunk_size}
+
+        chunks = list()
+        reused_count = 0
+
+        for filename, checksum, size in backup.sizes:
+            if size is None or size < self.chunk_threshold:
+                continue
+
+            entry = previous_chunks.get((filename, size, checksum))
+
+            if entry is not None:
+                chunks.append(entry)
+                reused_count += 1
+                continue
+
+            file_path = os.path.join(bytes(backup.backup_dir, 'utf8'),
+                                     filename)
+            current_checksum, file_chunks = backup.get_chunk_checksums(
+                file_path, self.chunk_size, self.governor.throttle)
+
+            if current_checksum != checksum:
+                self.logger.warning('Not adding chunk checksums for %s as it '
+                                    'does not match the checksum file',
+                                    file_path)
+                continue
+
+            chunks.append((filename, size, self.chunk_size, checksum,
+                           file_chunks))
+
+        self.logger.info('Added chunk checksums for %d large files (%d '
+                         'reused) to %s', len(chunks), reused_count,
+                         backup.path)
+
+        return chunks
+
+    def _get_metadata(self, backup):
+        record_inodes = self.config.getboolean(
+            'general', 'record_inodes',
+            fallback=self.global_config.getboolean(
+                'general', 'record_inodes', fallback=False))
+        path_prefix_len = len(bytes('%s/' % backup.backup_dir, 'utf8'))
+
+        for file_path, stat in backup.walk(sort=True, stat=True):
+            inode = stat.st_ino if record_inodes else None
+
+            yield (file_path[path_prefix_len:], stat.st_size,
+                   stat.st_mtime_ns, inode)
+
     def _get_new_logs(self, last_report):
         logs_to_report = list()
 
@@ -764,6 +3690,9 @@ class RsyncBackup(object):
                 ['pgrep', '--pidfile', self.pidfile, '-f', sys.argv[0]],
                 stdout=open(os.devnull, 'wb'))
             if process_check == 0:
+                self.logger.warning('A %s job of %s is already running. '
+                                    'Skipping.', self.job,
+                                    self.config.get('general', 'label'))
                 sys.exit()
 
         self._create_dir(os.path.dirname(self.pidfile))
@@ -771,6 +3700,16 @@ class RsyncBackup(object):
             f.write(pid)
         self.pid_created = True
 
+    @staticmethod
+    def _is_job_running(job, label):
+        try:
+            with open('/var/run/backup/%s-%s.pid' % (job, label), 'r') as f:
+                os.kill(int(f.read().strip()), 0)
+        except (FileNotFoundError, ProcessLookupError, ValueError):
+            return False
+
+        return True
+
     def _get_incomplete_backup(self):
         pattern = re.compile(r'^incomplete_[0-9-]{17}$')
 
@@ -823,12 +3762,20 @@ class RsyncBackup(object):
                 fallback=self.global_config.getboolean('reporting',
                                                        'link_to_logs'))
             if link_to_logs:
-                base_url = self.global_config.get('reporting', 'base_url')
+                # There may be a base_url for every backup root
+                base_urls = [url.strip() for url in self.global_config.get(
+                    'reporting', 'base_url').split(',')]
+                root = os.path.dirname(self.backup_root)
+                base_url = base_urls[0]
+
+                if (len(base_urls) == len(self.backup_roots.roots) and
+                        root in self.backup_roots.roots):
+                    base_url = base_urls[self.backup_roots.roots.index(root)]
+
                 url = '%s/%s' % (
                     base_url.rstrip('/'),
                     os.path.relpath(
-                        log_file,
-                            self.global_config.get('general', 'backup_root')))
+                        log_file, os.path.dirname(self.backup_root)))
                 summary = '%s%s: %s [ %s ]\n' % (
                     summary, os.path.splitext(os.path.basename(log_file))[0],
                     end_status, url)